@@ -1,35 +1,72 @@
 #!/usr/bin/env python3
 import os
+import sys
 import shutil
+import subprocess
 from pathlib import Path
 import argparse
+import sqlite3
 from datetime import datetime
-import imagehash
 from PIL import Image
 import numpy as np
 import pillow_heif
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from multiprocessing import cpu_count
 from tqdm import tqdm
+from photo_hashing import init_worker, hash_images, similar_hash_pairs, HASH_METHODS, HASH_DECODER
+from utils import content_digest
 
 # Register HEIF/HEIC file extensions with Pillow
 pillow_heif.register_heif_opener()
 
-def compute_image_hash(img_path):
-    """Compute perceptual hash for a single image."""
+# Hashes are keyed by absolute path, so one per-user cache serves every input
+# directory and runs don't leave a cache file wherever they were started
+DEFAULT_HASH_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "pepper-place", "dedupe_hash_cache.sqlite"
+)
+
+def hash_cache_table(method="phash"):
+    """Name of the hash cache table for method under the current JPEG decoder.
+    
+    OpenCV and Pillow resample differently, so their hashes are kept apart.
+    """
+    return f"{method}_{HASH_DECODER}"
+
+def open_hash_cache(cache_path, method="phash"):
+    """Open (creating if needed) the SQLite cache of previously computed hashes.
+    
+    Each hash method and decoder gets its own table (see hash_cache_table).
+    """
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(cache_path)
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {hash_cache_table(method)} ("
+        "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT)"
+    )
+    return conn
+
+def file_cache_key(img_path):
+    """Cache key for a file: it is re-hashed whenever its path, mtime or size changes.
+    
+    Returns None (after printing why) if the file can no longer be stat'ed.
+    """
     try:
-        img = Image.open(img_path)
-        # phash works well for slightly shifted images
-        h = imagehash.phash(img)
-        return str(img_path), str(h)
-    except Exception as e:
-        print(f"Error processing {img_path}: {e}")
+        st = os.stat(img_path)
+    except OSError as e:
+        print(f"Error reading {img_path}: {e}")
         return None
+    return os.path.abspath(img_path), st.st_mtime_ns, st.st_size
 
-def find_similar_images(directory, threshold=5):
-    """Find groups of similar images using perceptual hashing."""
+def find_similar_images(directory, threshold=5, cache_path=None, workers=None, use_threads=False, method="phash"):
+    """Find groups of similar images using perceptual hashing.
+    
+    If cache_path is given, hashes are looked up in (and saved to) a SQLite
+    cache there, so unchanged files are not decoded again on later runs.
+    workers, use_threads and method are passed through to hash_images.
+    """
     files = []
-    hash_dict = {}
     
     # Get all image files, including HEIC/HEIF formats
     for ext in ["*.jpg", "*.jpeg", "*.png", "*.JPG", "*.JPEG", "*.PNG", "*.heic", "*.HEIC", "*.heif", "*.HEIF"]:
@@ -38,117 +75,144 @@ def find_similar_images(directory, threshold=5):
     total_files = len(files)
     print(f"Processing {total_files} images...")
     
-    # Calculate hashes for all images in parallel
-    num_workers = max(1, cpu_count() - 1)  # Leave one CPU free
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        results = list(tqdm(
-            executor.map(compute_image_hash, files),
-            total=total_files,
-            desc="Hashing images",
+    image_hashes = {}
+    cache = open_hash_cache(cache_path, method) if cache_path else None
+    if cache is not None:
+        cache_keys = {}
+        for f in files:
+            key = file_cache_key(f)
+            if key is not None:
+                cache_keys[str(f)] = key
+        # Files gone or unreadable since the scan are skipped, like files
+        # that fail to hash
+        files = [f for f in files if str(f) in cache_keys]
+        for img_path, key in cache_keys.items():
+            row = cache.execute(
+                f"SELECT hash FROM {hash_cache_table(method)} WHERE path = ? AND mtime_ns = ? AND size = ?", key
+            ).fetchone()
+            if row:
+                image_hashes[img_path] = int(row[0], 16)
+        print(f"Reusing {len(image_hashes)} cached hashes")
+    
+    # Only decode files the cache could not answer for, and of those only one
+    # per set of byte-identical copies; the copies share its hash
+    misses = [f for f in files if str(f) not in image_hashes]
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        digests = list(tqdm(
+            executor.map(content_digest, misses),
+            total=len(misses),
+            desc="Checksumming images",
             unit="img"
         ))
-    
-    # Process results
-    for result in results:
-        if result is not None:
-            img_path, h_str = result
-            if h_str not in hash_dict:
-                hash_dict[h_str] = []
-            hash_dict[h_str].append(img_path)
+    representatives = {}
+    for f, digest in zip(misses, digests):
+        representatives.setdefault(digest if digest is not None else f, f)
+    print(f"Hashing {len(representatives)} distinct files ({len(misses) - len(representatives)} exact copies skipped)")
+    
+    representative_hashes = hash_images(list(representatives.values()), workers, use_threads, method)
+    new_hashes = {}
+    for f, digest in zip(misses, digests):
+        representative = representatives[digest if digest is not None else f]
+        h = representative_hashes.get(str(representative))
+        if h is not None:
+            new_hashes[str(f)] = h
+    image_hashes.update(new_hashes)
+    
+    if cache is not None:
+        with cache:
+            cache.executemany(
+                f"INSERT OR REPLACE INTO {hash_cache_table(method)} (path, mtime_ns, size, hash) VALUES (?, ?, ?, ?)",
+                [(*cache_keys[img_path], f"{h:016x}") for img_path, h in new_hashes.items()],
+            )
+        cache.close()
+    
+    # Parallel arrays of paths and hashes, sorted by hash so identical hashes
+    # form contiguous runs
+    paths = np.array([str(f) for f in files if str(f) in image_hashes], dtype=object)
+    hashes = np.fromiter((image_hashes[p] for p in paths), dtype=np.uint64, count=len(paths))
+    order = np.argsort(hashes, kind="stable")
+    hashes, paths = hashes[order], paths[order]
+    
+    # Exact matches come straight out of the sort; only the distinct hashes go
+    # through the near-duplicate search
+    unique_hashes, run_starts = np.unique(hashes, return_index=True)
+    runs = np.split(paths, run_starts[1:])
     
     # Find all potential duplicates (images with identical or very similar hashes)
-    similar_groups = []
-    processed_hashes = set()
-    
-    # Use tqdm for the hash comparison process too
-    for h1_str, img_list1 in tqdm(hash_dict.items(), desc="Finding duplicates", unit="hash"):
-        if h1_str in processed_hashes:
-            continue
-            
-        current_group = set(img_list1)
-        processed_hashes.add(h1_str)
-        h1 = imagehash.hex_to_hash(h1_str)
-        
-        # Find all similar hashes
-        for h2_str, img_list2 in hash_dict.items():
-            if h2_str in processed_hashes or h2_str == h1_str:
-                continue
-                
-            h2 = imagehash.hex_to_hash(h2_str)
-            if h1 - h2 <= threshold:
-                current_group.update(img_list2)
-                processed_hashes.add(h2_str)
-        
-        # Add ALL groups to similar_groups, not just those with multiple images
-        similar_groups.append(list(current_group))
+    parent = list(range(len(unique_hashes)))
     
-    return similar_groups
-
-# Move process_group outside to make it picklable
-def process_group(group_data_with_report_dir):
-    """Process a single group of similar images for the HTML report."""
-    (i, group), report_dir = group_data_with_report_dir
-    
-    if len(group) <= 1:
-        return ""  # Skip groups with no duplicates
-        
-    html = f"""
-    <div class="group">
-        <div class="group-header">Group {i+1}: {len(group)} similar images</div>
-        <div class="images">
-    """
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    for i, j in tqdm(similar_hash_pairs(unique_hashes.tolist(), threshold), desc="Finding duplicates", unit="pair"):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_i] = root_j
     
-    # The first image is the one we kept
-    kept_image = group[0]
-    relative_kept_path = os.path.basename(kept_image)
+    # Collect groups in hash order
+    groups = {}
+    for i in range(len(unique_hashes)):
+        groups.setdefault(find(i), []).extend(runs[i].tolist())
     
-    # Convert HEIC to JPG for the report if needed
-    report_img_filename = f"group_{i+1}_kept_{os.path.basename(kept_image)}"
-    report_img_path = os.path.join(report_dir, report_img_filename)
+    # Add ALL groups to similar_groups, not just those with multiple images
+    similar_groups = list(groups.values())
+    
+    return similar_groups
+
+# Longest edge of HEIC previews in the report; the page shows them at up to 200px
+REPORT_PREVIEW_SIZE = 400
+
+def export_report_image(src_path, report_img_path):
+    """Copy an image into the report directory, converting HEIC to a small JPEG preview.
     
-    if kept_image.lower().endswith(('.heic', '.heif')):
-        # Convert HEIC to JPG for the report
-        img = Image.open(kept_image)
+    Returns:
+        str: Path of the written file (extension becomes .jpg for HEIC sources)
+    """
+    if src_path.lower().endswith(('.heic', '.heif')):
+        # Decode with pillow_heif directly (8-bit, no HDR) and shrink before
+        # encoding, since browsers can't show HEIC and the report only needs a preview
+        img = pillow_heif.open_heif(src_path, convert_hdr_to_8bit=True).to_pillow()
+        img.thumbnail((REPORT_PREVIEW_SIZE, REPORT_PREVIEW_SIZE), Image.Resampling.BILINEAR)
         report_img_path = report_img_path.rsplit('.', 1)[0] + '.jpg'
-        img.save(report_img_path, format="JPEG")
+        img.convert("RGB").save(report_img_path, format="JPEG", quality=75)
     else:
-        shutil.copy2(kept_image, report_img_path)
+        clone_file(src_path, report_img_path)
+    return report_img_path
+
+def report_image_filename(i, role, img_path):
+    """Name of an image's copy in the report directory, e.g. group_3_kept_IMG_001.jpg"""
+    return f"group_{i+1}_{role}_{os.path.basename(img_path)}"
+
+def render_group_html(i, group, report_img_paths):
+    """Render the HTML for one group of similar images in the report.
     
-    html += f"""
-        <div class="image-container">
-            <img src="{os.path.basename(report_img_path)}" class="thumbnail kept">
-            <div class="filename">{relative_kept_path} (KEPT)</div>
-        </div>
+    Args:
+        i: Group index
+        group: Image paths; the first one is the image we kept
+        report_img_paths: Map from source path to its exported copy in the report directory
     """
+    fragments = [f"""
+    <div class="group">
+        <div class="group-header">Group {i+1}: {len(group)} similar images</div>
+        <div class="images">
+    """]
     
-    # Add all the removed images
-    for removed_image in group[1:]:
-        relative_removed_path = os.path.basename(removed_image)
-        
-        # Convert HEIC to JPG for the report if needed
-        report_img_filename = f"group_{i+1}_removed_{os.path.basename(removed_image)}"
-        report_img_path = os.path.join(report_dir, report_img_filename)
-        
-        if removed_image.lower().endswith(('.heic', '.heif')):
-            # Convert HEIC to JPG for the report
-            img = Image.open(removed_image)
-            report_img_path = report_img_path.rsplit('.', 1)[0] + '.jpg'
-            img.save(report_img_path, format="JPEG")
-        else:
-            shutil.copy2(removed_image, report_img_path)
-        
-        html += f"""
+    for img_path, label in [(group[0], "KEPT")] + [(p, "REMOVED") for p in group[1:]]:
+        fragments.append(f"""
             <div class="image-container">
-                <img src="{os.path.basename(report_img_path)}" class="thumbnail removed">
-                <div class="filename">{relative_removed_path} (REMOVED)</div>
+                <img src="{os.path.basename(report_img_paths[img_path])}" class="thumbnail {label.lower()}">
+                <div class="filename">{os.path.basename(img_path)} ({label})</div>
             </div>
-        """
+        """)
     
-    html += """
+    fragments.append("""
         </div>
     </div>
-    """
-    return html
+    """)
+    return "".join(fragments)
 
 def create_html_report(similar_groups, output_dir):
     """Create an HTML report showing duplicate groups."""
@@ -158,7 +222,7 @@ def create_html_report(similar_groups, output_dir):
     
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    html_content = f"""
+    fragments = [f"""
     <!DOCTYPE html>
     <html>
     <head>
@@ -178,42 +242,87 @@ def create_html_report(similar_groups, output_dir):
     <body>
         <h1>Duplicate Images Report</h1>
         <p>Generated on: {current_time}</p>
-    """
+    """]
     
     # Only show groups with duplicates
     duplicate_groups = [group for group in similar_groups if len(group) > 1]
     
-    # Use concurrent.futures for report generation too
-    with ProcessPoolExecutor(max_workers=max(1, cpu_count() - 1)) as executor:
-        # Pass report_dir as part of the arguments
-        group_data = [((i, group), report_dir) for i, group in enumerate(duplicate_groups)]
-        html_fragments = list(tqdm(
-            executor.map(process_group, group_data), 
-            total=len(group_data),
-            desc="Generating HTML report",
-            unit="group"
+    # Copying/converting the images is the only real work; do it in threads
+    # (file I/O and Pillow both release the GIL) and keep the HTML in this process
+    export_tasks = []
+    for i, group in enumerate(duplicate_groups):
+        export_tasks.append((group[0], os.path.join(report_dir, report_image_filename(i, "kept", group[0]))))
+        for removed_image in group[1:]:
+            export_tasks.append((removed_image, os.path.join(report_dir, report_image_filename(i, "removed", removed_image))))
+    
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        exported = list(tqdm(
+            executor.map(lambda task: export_report_image(*task), export_tasks),
+            total=len(export_tasks),
+            desc="Exporting report images",
+            unit="img"
         ))
+    report_img_paths = {src: dest for (src, _), dest in zip(export_tasks, exported)}
     
-    html_content += "".join(html_fragments)
+    fragments.extend(render_group_html(i, group, report_img_paths) for i, group in enumerate(duplicate_groups))
     
-    html_content += """
+    fragments.append("""
     </body>
     </html>
-    """
+    """)
     
     with open(os.path.join(report_dir, "report.html"), "w") as f:
-        f.write(html_content)
+        f.write("".join(fragments))
     
     return os.path.join(report_dir, "report.html")
 
+# Linux ioctl that makes dst share src's data blocks (Btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+def clone_file(src_path, dest_path, hardlink=False):
+    """Copy a file as cheaply as the filesystem allows.
+    
+    Tries, in order: a hard link (only if hardlink is set), a copy-on-write
+    clone (FICLONE on Linux, `cp -c` on APFS), and finally shutil.copy2. The
+    first two only write metadata, not the file's bytes.
+    """
+    if os.path.lexists(dest_path):
+        try:
+            if os.path.samefile(src_path, dest_path):
+                return  # Already linked (or output_dir is the input directory)
+        except FileNotFoundError:
+            pass  # dest_path is a broken symlink
+        os.unlink(dest_path)
+    
+    if hardlink:
+        try:
+            os.link(src_path, dest_path)
+            return
+        except OSError:
+            pass  # e.g. different filesystems
+    
+    if sys.platform == "linux":
+        import fcntl
+        try:
+            with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            shutil.copystat(src_path, dest_path)
+            return
+        except OSError:
+            pass  # Filesystem doesn't support reflinks
+    elif sys.platform == "darwin":
+        result = subprocess.run(["cp", "-c", "-p", src_path, dest_path], capture_output=True)
+        if result.returncode == 0:
+            return
+    
+    shutil.copy2(src_path, dest_path)
+
 def process_and_copy_image(group_data):
     """Process and copy a single image group with progress tracking."""
-    group, output_dir, convert_heic = group_data
+    group, output_dir, convert_heic, hardlink = group_data
     
-    # Sort by creation time to keep the earliest image
-    group.sort(key=lambda x: os.path.getctime(x))
-    
-    # Copy the first (earliest) image to output directory
+    # Copy the first (earliest) image to output directory; main() has already
+    # sorted the group by creation time
     src_path = group[0]
     filename = os.path.basename(src_path)
     dest_path = os.path.join(output_dir, filename)
@@ -225,7 +334,7 @@ def process_and_copy_image(group_data):
         img = Image.open(src_path)
         img.save(dest_path, format="JPEG")
     else:
-        shutil.copy2(src_path, dest_path)
+        clone_file(src_path, dest_path, hardlink)
     
     return len(group)
 
@@ -235,7 +344,12 @@ def main():
     parser.add_argument("output_dir", help="Directory to save unique images (will be created if it doesn't exist)")
     parser.add_argument("--threshold", type=int, default=5, help="Perceptual hash difference threshold (default: 5)")
     parser.add_argument("--convert-heic", action="store_true", help="Convert HEIC files to JPG in output directory")
-    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count - 1)")
+    parser.add_argument("--hardlink", action="store_true", help="Hard-link unique images into the output directory instead of copying them")
+    parser.add_argument("--workers", type=int, default=None, help="Number of decode workers: processes, or threads with --threads (default: CPU count - 1)")
+    parser.add_argument("--hash-method", choices=sorted(HASH_METHODS), default="phash", help="Perceptual hash to compare: phash tolerates small shifts and edits, dhash is faster and suits exact re-saves and bursts (default: phash)")
+    parser.add_argument("--threads", action="store_true", help="Decode images with threads instead of worker processes")
+    parser.add_argument("--hash-cache", default=DEFAULT_HASH_CACHE, help=f"SQLite file for caching image hashes between runs (default: {DEFAULT_HASH_CACHE})")
+    parser.add_argument("--no-hash-cache", action="store_true", help="Always re-hash every image")
     args = parser.parse_args()
     
     input_dir = args.input_dir
@@ -251,9 +365,10 @@ def main():
     os.makedirs(output_dir, exist_ok=True)
     
     print(f"Finding similar images in {input_dir} with threshold {threshold}...")
-    print(f"Using {workers} worker processes")
+    print(f"Using {workers} worker {'threads' if args.threads else 'processes'}")
     
-    similar_groups = find_similar_images(input_dir, threshold)
+    cache_path = None if args.no_hash_cache else args.hash_cache
+    similar_groups = find_similar_images(input_dir, threshold, cache_path, workers, args.threads, args.hash_method)
     
     # Count total images and duplicates
     total_images = sum(len(group) for group in similar_groups)
@@ -265,9 +380,16 @@ def main():
         print("\nNo images found in the input directory.")
         return
     
+    # Sort each group by creation time so the earliest image comes first, with
+    # one stat per file. Doing it here rather than in the copy workers also means
+    # the report shows the image that was actually kept
+    ctimes = {img_path: os.stat(img_path).st_ctime for group in similar_groups for img_path in group}
+    for group in similar_groups:
+        group.sort(key=ctimes.get)
+    
     # Copy only one image from each group to output directory (in parallel)
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        group_data = [(group, output_dir, convert_heic) for group in similar_groups]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        group_data = [(group, output_dir, convert_heic, args.hardlink) for group in similar_groups]
         _ = list(tqdm(
             executor.map(process_and_copy_image, group_data),
             total=len(group_data),
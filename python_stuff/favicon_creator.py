@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from PIL import Image
+import numpy as np
 import os
 
 def create_favicon(input_path, output_path="favicon.ico", sizes=[16, 32, 48, 64, 128, 256]):
@@ -17,19 +18,23 @@ def create_favicon(input_path, output_path="favicon.ico", sizes=[16, 32, 48, 64,
     
     # Create a transparent mask by identifying white pixels
     # This assumes the white background to remove has RGB values close to (255, 255, 255)
-    width, height = img.size
-    for x in range(width):
-        for y in range(height):
-            r, g, b, a = img.getpixel((x, y))
-            # If the pixel is white or very light (threshold can be adjusted)
-            if r > 240 and g > 240 and b > 240:
-                # Set alpha to 0 (transparent)
-                img.putpixel((x, y), (r, g, b, 0))
+    pixels = np.array(img)
+    # If the pixel is white or very light (threshold can be adjusted)
+    white = (pixels[..., 0] > 240) & (pixels[..., 1] > 240) & (pixels[..., 2] > 240)
+    # Set alpha to 0 (transparent)
+    pixels[white, 3] = 0
+    img = Image.fromarray(pixels)
+    
+    # Reduce the original once to the largest icon size (reducing_gap box-reduces
+    # most of the way before LANCZOS), then derive every smaller size from that
+    largest = max(sizes)
+    base = img.copy()
+    base.thumbnail((largest, largest), Image.Resampling.LANCZOS, reducing_gap=2.0)
     
     # Create resized versions
     resized_images = []
     for size in sizes:
-        resized_img = img.copy()
+        resized_img = base.copy()
         resized_img.thumbnail((size, size), Image.Resampling.LANCZOS)
         resized_images.append(resized_img)
     
@@ -0,0 +1,277 @@
+from PIL import Image
+import numpy as np
+import pillow_heif
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import cpu_count, shared_memory
+from functools import partial
+from tqdm import tqdm
+
+try:
+    import faiss  # Optional: sub-linear near-duplicate search for large libraries
+except ImportError:
+    faiss = None
+
+try:
+    import cupy  # Optional: runs the near-duplicate matrix product on the GPU
+except ImportError:
+    cupy = None
+
+try:
+    import cv2  # Optional: libjpeg-turbo JPEG decoding for hash inputs
+except ImportError:
+    cv2 = None
+
+# Decoder used for JPEG hash inputs; OpenCV and Pillow resample differently
+HASH_DECODER = "cv2" if cv2 is not None else "pil"
+
+# Register HEIF/HEIC file extensions with Pillow
+pillow_heif.register_heif_opener()
+
+def init_worker():
+    """Pool initializer: get Pillow fully set up before the first task arrives.
+    
+    Image.init() imports every format plugin up front instead of on the first
+    file that needs one, and the HEIF opener is registered explicitly so it is
+    in place however the worker was started (fork, spawn or forkserver).
+    """
+    Image.init()
+    pillow_heif.register_heif_opener()
+
+# phash geometry, matching imagehash.phash: DCT of a 32x32 grayscale image,
+# keeping the top-left 8x8 block of low frequencies
+HASH_SIZE = 8
+PHASH_IMAGE_SIZE = HASH_SIZE * 4
+
+# First HASH_SIZE rows of the unnormalized type-II DCT basis (scipy's default),
+# so the low-frequency block is two small matrix products instead of a full 2D DCT
+_dct_n = np.arange(PHASH_IMAGE_SIZE)
+DCT_LOW = 2 * np.cos(
+    np.pi * np.arange(HASH_SIZE)[:, None] * (2 * _dct_n[None, :] + 1) / (2 * PHASH_IMAGE_SIZE)
+)
+
+def phash_batch(pixels):
+    """Compute 64-bit phashes for a stack of 32x32 grayscale images.
+    
+    Args:
+        pixels: Array of shape (N, 32, 32)
+        
+    Returns:
+        List of N hashes as Python ints
+    """
+    # One broadcast matmul over the whole stack instead of a DCT call per image
+    dct_low = (DCT_LOW @ pixels.astype(np.float64) @ DCT_LOW.T).reshape(len(pixels), -1)
+    bits = dct_low > np.median(dct_low, axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel().tolist()
+
+def dhash_batch(pixels):
+    """Compute 64-bit dhashes for a stack of 8x9 grayscale images.
+    
+    Each bit says whether a pixel is brighter than its left neighbour, matching
+    imagehash.dhash. No DCT is involved, so this is cheaper than phash but less
+    tolerant of crops and shifts.
+    
+    Args:
+        pixels: Array of shape (N, 8, 9)
+        
+    Returns:
+        List of N hashes as Python ints
+    """
+    bits = (pixels[:, :, 1:] > pixels[:, :, :-1]).reshape(len(pixels), -1)
+    return np.packbits(bits, axis=1).view(">u8").ravel().tolist()
+
+# Per hash method: (rows, cols) of the grayscale input and the batch hash function
+HASH_METHODS = {
+    "phash": ((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), phash_batch),
+    "dhash": ((HASH_SIZE, HASH_SIZE + 1), dhash_batch),
+}
+
+# Worker-side view of the shared (N, rows, cols) pixel buffer, attached once per
+# process by attach_pixel_buffer
+_pixel_shm = None
+_pixel_buffer = None
+_pixel_files = None
+
+def attach_pixel_buffer(shm_name, shape, files):
+    """Pool initializer: map the shared pixel buffer into this worker process.
+    
+    The file list is sent once per worker here, so tasks are bare indexes.
+    """
+    global _pixel_shm, _pixel_buffer, _pixel_files
+    init_worker()
+    _pixel_shm = shared_memory.SharedMemory(name=shm_name)
+    _pixel_buffer = np.ndarray(shape, dtype=np.uint8, buffer=_pixel_shm.buf)
+    _pixel_files = files
+
+def decode_jpeg_gray_cv2(img_path, rows, cols):
+    """Decode a JPEG to a (rows, cols) grayscale array with OpenCV.
+    
+    Picks the largest libjpeg DCT scaling (1/8, 1/4, 1/2) that still leaves at
+    least twice the target size, then area-resamples down.
+    
+    Returns:
+        np.ndarray or None if OpenCV could not decode the file
+    """
+    # Only the header is read here, to get the dimensions
+    with Image.open(img_path) as img:
+        width, height = img.size
+    for factor, flag in (
+        (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+        (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+        (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+        (1, cv2.IMREAD_GRAYSCALE),
+    ):
+        if width // factor >= cols * 2 and height // factor >= rows * 2:
+            break
+    # Ignore EXIF orientation, like the Pillow path, so both give the same hash
+    gray = cv2.imread(str(img_path), flag | cv2.IMREAD_IGNORE_ORIENTATION)
+    if gray is None:
+        return None
+    return cv2.resize(gray, (cols, rows), interpolation=cv2.INTER_AREA)
+
+def load_hash_pixels(task, buffer=None):
+    """Decode an image and write its small grayscale hash input into the pixel buffer.
+    
+    Args:
+        task: (index, img_path) tuple; index is the image's row in the buffer
+        buffer: (N, rows, cols) array to write into (default: the worker's shared
+            buffer); its shape sets the size the image is reduced to
+        
+    Returns:
+        bool: True if the row was filled, False if the image could not be read
+    """
+    index, img_path = task
+    if buffer is None:
+        buffer = _pixel_buffer
+    rows, cols = buffer.shape[1:]
+    try:
+        pixels = None
+        if cv2 is not None and str(img_path).lower().endswith((".jpg", ".jpeg")):
+            pixels = decode_jpeg_gray_cv2(img_path, rows, cols)
+        if pixels is None:
+            img = Image.open(img_path)
+            # Let the JPEG decoder produce grayscale at up to 1/8 scale instead of
+            # full-resolution RGB (no-op for other formats)
+            img.draft("L", (cols * 2, rows * 2))
+            # reducing_gap box-reduces large inputs before the LANCZOS pass
+            img = img.convert("L").resize((cols, rows), Image.Resampling.LANCZOS, reducing_gap=2.0)
+            pixels = np.asarray(img, dtype=np.uint8)
+        buffer[index] = pixels
+        return True
+    except Exception as e:
+        print(f"Error processing {img_path}: {e}")
+        return False
+
+def load_indexed_hash_pixels(index):
+    """Worker task: load_hash_pixels for the index'th file of the worker's file list."""
+    return load_hash_pixels((index, _pixel_files[index]))
+
+def hash_images(files, workers=None, use_threads=False, method="phash"):
+    """Decode and hash images in parallel.
+    
+    Args:
+        files: Image paths to hash
+        workers: Number of decode workers (default: CPU count - 1)
+        use_threads: Decode in a thread pool instead of worker processes
+        method: Hash method, a key of HASH_METHODS
+        
+    Returns:
+        Dict mapping each readable image path (as str) to its hash
+    """
+    total_files = len(files)
+    if total_files == 0:
+        return {}
+    
+    num_workers = workers or max(1, cpu_count() - 1)  # Leave one CPU free
+    (rows, cols), hash_batch = HASH_METHODS[method]
+    shape = (total_files, rows, cols)
+    
+    if use_threads:
+        # Pillow releases the GIL while decoding and resampling, so threads can
+        # fill one ordinary array without spawning or pickling anything
+        pixels = np.empty(shape, dtype=np.uint8)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            loaded = list(tqdm(
+                executor.map(partial(load_hash_pixels, buffer=pixels), enumerate(files)),
+                total=total_files,
+                desc="Decoding images",
+                unit="img"
+            ))
+        loaded = np.array(loaded, dtype=bool)
+        img_paths = [str(f) for f, ok in zip(files, loaded) if ok]
+        hashes = hash_batch(pixels[loaded]) if img_paths else []
+        return dict(zip(img_paths, hashes))
+    
+    # Worker processes decode and shrink images straight into shared memory, so
+    # only an index goes in and a bool comes back per image (the paths travel
+    # once per worker, with the initializer); hashing happens afterwards in one batch
+    shm = shared_memory.SharedMemory(create=True, size=total_files * rows * cols)
+    pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=attach_pixel_buffer,
+            initargs=(shm.name, shape, [str(f) for f in files]),
+        ) as executor:
+            # Hand files to workers in batches to cut per-task IPC round trips
+            chunksize = max(1, min(64, total_files // (num_workers * 4)))
+            loaded = list(tqdm(
+                executor.map(load_indexed_hash_pixels, range(total_files), chunksize=chunksize),
+                total=total_files,
+                desc="Decoding images",
+                unit="img"
+            ))
+        
+        # Hash every decoded image at once
+        loaded = np.array(loaded, dtype=bool)
+        img_paths = [str(f) for f, ok in zip(files, loaded) if ok]
+        hashes = hash_batch(pixels[loaded]) if img_paths else []
+    finally:
+        # Drop the view before closing, or the buffer is still exported
+        del pixels
+        shm.close()
+        shm.unlink()
+    
+    return dict(zip(img_paths, hashes))
+
+def similar_hash_pairs(hashes, threshold, batch_size=2048):
+    """Yield (i, j) index pairs, i < j, of hashes that differ by at most threshold bits.
+    
+    Uses a FAISS multi-index hash when faiss is installed, otherwise a blocked
+    matrix product over the hash bits (on the GPU if CuPy is installed).
+    """
+    if len(hashes) < 2:
+        return
+    
+    codes = np.array(hashes, dtype=">u8").view(np.uint8).reshape(-1, 8)
+    
+    if faiss is not None:
+        # Multi-index hashing over 4 tables of 16 bits: by pigeonhole, any pair
+        # within threshold bits differs by at most threshold // 4 bits in some table
+        index = faiss.IndexBinaryMultiHash(64, 4, 16)
+        index.nflip = threshold // 4
+        index.add(codes)
+        # The search radius is exclusive
+        lims, _, neighbors = index.range_search(codes, threshold + 1)
+        for i in range(len(hashes)):
+            for j in neighbors[lims[i]:lims[i + 1]].tolist():
+                if j > i:
+                    yield i, j
+        return
+    
+    # With bits encoded as +/-1, the dot product of two hashes is
+    # 64 - 2 * (Hamming distance), so each tile of the upper triangle is one
+    # GEMM. Tiles are batch_size square, so memory stays fixed however large
+    # the library. float32 is exact here since every dot product is in [-64, 64]
+    xp = cupy if cupy is not None else np
+    signs = xp.asarray(np.unpackbits(codes, axis=1).astype(np.float32) * 2 - 1)
+    min_dot = 64 - 2 * threshold
+    for start in range(0, len(hashes), batch_size):
+        block = signs[start:start + batch_size]
+        for col_start in range(start, len(hashes), batch_size):
+            dots = block @ signs[col_start:col_start + batch_size].T
+            rows, cols = xp.nonzero(dots >= min_dot)
+            if xp is not np:
+                rows, cols = xp.asnumpy(rows), xp.asnumpy(cols)
+            rows, cols = rows + start, cols + col_start
+            keep = cols > rows
+            yield from zip(rows[keep].tolist(), cols[keep].tolist())
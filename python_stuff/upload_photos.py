@@ -1,35 +1,37 @@
 import os
+import math
 from datetime import datetime
 from minio import Minio
+import certifi
+import urllib3
 from minio.error import S3Error
-from PIL import Image
-from PIL.ExifTags import TAGS
+from PIL import Image, ImageOps, features
 import io
 import hashlib
+import gzip
+import sqlite3
 from dotenv import load_dotenv
 from tqdm import tqdm
-import tempfile
-import mimetypes
 import json
+import re
 import argparse
-from typing import Tuple, List, Dict, Any
+from collections import Counter
+from typing import Tuple, List, Dict, Any, Optional
 import concurrent.futures
 from functools import partial
 import threading
-from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor
-import imagehash
-import pillow_heif
 
 # Import utility functions
 from utils import get_exif_date
-from utils import convert_heic_to_jpeg
+from utils import HEIC_EXTENSIONS
+from utils import file_extension
+from utils import open_heic_image
 from utils import create_video_thumbnail
-from utils import validate_video_file
-from utils import validate_image_file
-from utils import get_video_metadata
+from utils import probe_video
 from utils import optimize_video
 from utils import generate_blurhash
+from utils import ExifToolDaemon
+from utils import content_digest
 
 # Load environment variables
 load_dotenv(".env")
@@ -47,15 +49,16 @@ BUCKET_NAME = "pepper-photos"
 PHOTOS_DIR = "../dog_images"
 
 # Supported file extensions
-IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic", ".heif")
-VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".m4v")
-SKIP_FILES = (".ds_store", "thumbs.db")
+IMAGE_EXTENSIONS = frozenset((".jpg", ".jpeg", ".png", ".heic", ".heif"))
+VIDEO_EXTENSIONS = frozenset((".mp4", ".mov", ".avi", ".m4v"))
+SKIP_FILES = frozenset((".ds_store", "thumbs.db"))
+MEDIA_EXTENSIONS = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
 
 # Format conversion settings
-CONVERT_HEIC = True  # Convert HEIC to JPEG
-WEB_IMAGE_FORMAT = "WEBP"  # Target format for web images
-WEB_IMAGE_QUALITY = 75  # Quality for web images (reduced from 85)
+CONVERT_HEIC = True  # Decode HEIC once, upright and as RGB, for all outputs
 SKIP_VIDEO_THUMBNAILS = False  # Skip video thumbnail creation
+STORED_KEYS = frozenset()  # Object keys already in the bucket, set per run by init_worker
+RECORDED_KEYS = frozenset()  # Media keys listed in metadata.json or the manifest, set per run by init_worker
 
 # Image optimization settings
 IMAGE_SIZES = {
@@ -65,22 +68,60 @@ IMAGE_SIZES = {
 }
 MAIN_IMAGE_FORMAT = "WEBP"  # Modern format for better compression
 MAIN_IMAGE_QUALITY = 75  # Reduced quality for better compression (was 85)
+MAIN_IMAGE_METHOD = 4  # WebP effort (0-6); 6 is several times slower for ~1-2% smaller files
+MAIN_IMAGE_ALPHA_QUALITY = 90  # Lossy quality for transparent images (lossless is far slower)
+
+# Thumbnail settings - smaller dimensions aligned with display size
+THUMBNAIL_SIZE = (80, 100)
+THUMBNAIL_QUALITY = 70  # Lower quality is fine for small thumbnails
+THUMBNAIL_FORMAT = "WEBP"  # WebP format for better compression
+THUMBNAIL_METHOD = 0  # Fastest WebP effort; size differences are negligible at this size
 
 # Maximum file size and duration limits
 MAX_VIDEO_SIZE_MB = 10  # Maximum video size in MB
 MAX_VIDEO_DURATION_SECONDS = 5  # Maximum video duration in seconds
 
+# Images up to this size are read into memory once for both hashing and decoding
+MAX_IMAGE_READ_BYTES = 100 * 1024 * 1024
+
 # Parallelization settings
-MAX_WORKERS_PROCESS = max(os.cpu_count() - 1, 1)  # Leave one CPU free
+# CPUs this process may actually run on (fewer than os.cpu_count() under
+# taskset or container CPU limits), so the decode pool doesn't oversubscribe
+AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+MAX_WORKERS_PROCESS = max(AVAILABLE_CPUS - 1, 1)  # Leave one CPU free
 MAX_WORKERS_THREAD = 10  # Concurrent uploads
-BATCH_SIZE = 10  # Process files in batches
+MAX_IN_FLIGHT_FILES = 32  # Files being prepared or uploaded at once (bounds buffered output)
+# Estimated memory to prepare the in-flight files may not exceed half of RAM,
+# so a run of huge images can't push workers into swap
+try:
+    MAX_IN_FLIGHT_BYTES = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+except (AttributeError, ValueError, OSError):
+    MAX_IN_FLIGHT_BYTES = None  # Unknown (e.g. Windows): only MAX_IN_FLIGHT_FILES applies
+
+# Objects that split into at least two legal parts are uploaded as multipart,
+# several parts at a time
+S3_MIN_PART_SIZE = 5 * 1024 * 1024  # Minimum size of every part but the last
+MULTIPART_THRESHOLD = 2 * S3_MIN_PART_SIZE
+MULTIPART_PART_SIZE = 16 * 1024 * 1024  # Largest part size used
+MULTIPART_PARALLEL_UPLOADS = 4
+
+# Files already uploaded, so unchanged ones are skipped on later runs
+UPLOAD_CACHE_PATH = "upload_cache.sqlite"
 
-# Thread-local storage for MinIO clients
-local_minio_clients = threading.local()
+# media/YEAR/MONTH/FILENAME object keys, as listed when rebuilding the manifest
+MEDIA_KEY_RE = re.compile(r"media/(\d+)/(\d+)/([^/]+)$")
 
+# MinIO client shared by the upload threads, created on first use
+minio_client_shared = None
+minio_client_lock = threading.Lock()
 
-def setup_minio_client():
-    """Setup and return MinIO client"""
+
+def setup_minio_client(pool_size: int = 10):
+    """Setup and return MinIO client
+
+    pool_size is the number of connections kept open to the endpoint; size it
+    to the number of concurrent requests so none re-handshake TLS.
+    """
     # Remove http:// or https:// from endpoint if present
     endpoint = MINIO_ENDPOINT
     secure = False
@@ -96,14 +137,83 @@ def setup_minio_client():
         access_key=MINIO_ACCESS_KEY,
         secret_key=MINIO_SECRET_KEY,
         secure=secure,
+        http_client=urllib3.PoolManager(
+            num_pools=1,
+            maxsize=pool_size,
+            block=True,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            timeout=urllib3.Timeout(connect=5, read=60),
+            retries=urllib3.Retry(
+                total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504]
+            ),
+        ),
     )
 
 
 def get_minio_client():
-    """Get thread-local MinIO client"""
-    if not hasattr(local_minio_clients, "client"):
-        local_minio_clients.client = setup_minio_client()
-    return local_minio_clients.client
+    """Get the shared MinIO client (thread-safe, used by all upload threads)
+
+    Its connection pool holds one connection per concurrent part upload, so
+    connections are reused rather than reopened.
+    """
+    global minio_client_shared
+    with minio_client_lock:
+        if minio_client_shared is None:
+            minio_client_shared = setup_minio_client(MAX_WORKERS_THREAD * MULTIPART_PARALLEL_UPLOADS)
+    return minio_client_shared
+
+
+def init_worker(
+    skip_video_thumbnails: bool, stored_keys: frozenset = frozenset(), recorded_keys: frozenset = frozenset()
+):
+    """Process pool initializer: apply command-line settings in each worker
+
+    Spawned workers re-import this module, so settings assigned in __main__
+    would otherwise revert to their defaults. The keys already in the bucket
+    (and those already recorded in metadata.json or the manifest) are sent
+    once per worker here rather than with every file. Pillow's format plugins are
+    loaded here too, rather than on the first file each worker opens (the HEIF
+    opener is registered once per process when utils is imported).
+    """
+    global SKIP_VIDEO_THUMBNAILS, STORED_KEYS, RECORDED_KEYS
+    SKIP_VIDEO_THUMBNAILS = skip_video_thumbnails
+    STORED_KEYS = stored_keys
+    RECORDED_KEYS = recorded_keys
+    Image.init()
+
+
+def multipart_part_size(size: int) -> int:
+    """Split size into equal MiB-aligned parts of at most MULTIPART_PART_SIZE
+
+    Evenly sized parts keep every connection busy until the end instead of
+    leaving a small tail part to go up on its own.
+    """
+    mib = 1024 * 1024
+    parts = max(2, -(-size // MULTIPART_PART_SIZE))
+    return max(S3_MIN_PART_SIZE, -(-size // (parts * mib)) * mib)
+
+
+def upload_buffer(key: str, buffer: io.BytesIO, size: int, content_type: str):
+    """Upload an in-memory buffer to MinIO (runs on an upload thread)
+
+    Large objects are sent as equal parts over several connections; anything
+    under MULTIPART_THRESHOLD goes as a single PUT.
+    """
+    multipart = {}
+    if size >= MULTIPART_THRESHOLD:
+        multipart = {
+            "part_size": multipart_part_size(size),
+            "num_parallel_uploads": MULTIPART_PARALLEL_UPLOADS,
+        }
+    get_minio_client().put_object(
+        BUCKET_NAME,
+        key,
+        buffer,
+        size,
+        content_type=content_type,
+        **multipart,
+    )
 
 
 def ensure_bucket_exists(minio_client):
@@ -118,106 +228,107 @@ def ensure_bucket_exists(minio_client):
         print(f"Error checking/creating bucket: {e}")
 
 
+def open_image(file_path, data=None):
+    """Open an image once for its date, main sizes and thumbnail
+
+    HEIC files are decoded upright by pillow-heif; other images are returned
+    as opened (not yet rotated) so their EXIF can still be read. If data (the
+    file's bytes) is given, it is decoded instead of reading the file again.
+    """
+    fp = io.BytesIO(data) if data is not None else None
+    if file_extension(file_path) in HEIC_EXTENSIONS and CONVERT_HEIC:
+        image = open_heic_image(file_path, fp)
+        if image is None:
+            raise ValueError(f"Could not decode HEIC {file_path}")
+        return image
+    return Image.open(fp if fp is not None else file_path)
+
+
+def draft_jpeg(image, max_size):
+    """Have libjpeg decode a JPEG at a reduced DCT scale (1/2, 1/4 or 1/8)
+
+    The scale is the smallest that still covers max_size in either orientation,
+    since EXIF rotation is applied after decoding. No-op for other formats.
+    """
+    if image.format != "JPEG":
+        return image
+    width, height = image.size
+    max_w, max_h = max_size
+    ratio = max(min(max_w / width, max_h / height), min(max_h / width, max_w / height))
+    if ratio < 1.0:
+        image.draft("RGB", (math.ceil(width * ratio), math.ceil(height * ratio)))
+    return image
+
+
+def open_main_image(file_path, data=None):
+    """Open an image for its main sizes, checking that it has usable dimensions
+
+    JPEGs only need decoding at the largest main size.
+    """
+    image = draft_jpeg(open_image(file_path, data), IMAGE_SIZES["large"])
+    width, height = image.size
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Invalid image dimensions: {width}x{height}")
+    return image
+
+
+def create_image_thumbnail(image):
+    """Create a thumbnail from an already opened, upright image
+
+    The image is shrunk in place, so this should be the last use of it.
+    """
+    try:
+        # BILINEAR is indistinguishable from LANCZOS at this size and cheaper
+        image.thumbnail(THUMBNAIL_SIZE, Image.Resampling.BILINEAR)
+        thumbnail_buffer = io.BytesIO()
+        # Save as WebP for better compression and web compatibility
+        if image.mode == "RGBA":
+            # For transparent images, WebP also supports transparency
+            image.save(thumbnail_buffer, format=THUMBNAIL_FORMAT, method=THUMBNAIL_METHOD)
+        else:
+            image.save(
+                thumbnail_buffer, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, method=THUMBNAIL_METHOD
+            )
+        thumbnail_buffer.seek(0)
+        return thumbnail_buffer
+    except Exception as e:
+        print(f"Error creating thumbnail: {e}")
+        return None
+
+
 def create_thumbnail(file_path):
-    """Create a thumbnail for an image or video"""
-    # Smaller thumbnail dimensions - aligned with display size
-    THUMBNAIL_SIZE = (80, 100)
-    THUMBNAIL_QUALITY = 70  # Lower quality is fine for small thumbnails
-    THUMBNAIL_FORMAT = "WEBP"  # WebP format for better compression
-    
-    if any(file_path.lower().endswith(ext) for ext in VIDEO_EXTENSIONS):
-        if SKIP_VIDEO_THUMBNAILS:
-            print("Skipping video thumbnail (disabled)")
-            return None
-        return create_video_thumbnail(file_path, size=THUMBNAIL_SIZE)
-    elif file_path.lower().endswith((".heic", ".heif")) and CONVERT_HEIC:
-        # Convert HEIC to JPEG first, then create thumbnail
-        jpeg_buffer = convert_heic_to_jpeg(file_path, WEB_IMAGE_QUALITY)
-        if jpeg_buffer:
-            try:
-                image = Image.open(jpeg_buffer)
-                # Apply orientation correction
-                image = apply_exif_orientation(image)
-                image.thumbnail(THUMBNAIL_SIZE)
-                thumbnail_buffer = io.BytesIO()
-                image.save(thumbnail_buffer, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
-                thumbnail_buffer.seek(0)
-                return thumbnail_buffer
-            except Exception as e:
-                print(f"Error creating thumbnail from HEIC {file_path}: {e}")
-                return None
+    """Create a thumbnail for a video
+
+    Image thumbnails come from the already decoded image, in create_image_outputs.
+    """
+    if SKIP_VIDEO_THUMBNAILS:
+        print("Skipping video thumbnail (disabled)")
         return None
-    else:
-        try:
-            image = Image.open(file_path)
-            # Apply orientation correction
-            image = apply_exif_orientation(image)
-            image.thumbnail(THUMBNAIL_SIZE)
-            thumbnail_buffer = io.BytesIO()
-            # Save as WebP for better compression and web compatibility
-            if image.format == "PNG" and image.mode == "RGBA":
-                # For transparent images, WebP also supports transparency
-                image.save(thumbnail_buffer, format=THUMBNAIL_FORMAT)
-            else:
-                image.save(
-                    thumbnail_buffer, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY
-                )
-            thumbnail_buffer.seek(0)
-            return thumbnail_buffer
-        except Exception as e:
-            print(f"Error creating thumbnail for {file_path}: {e}")
-            return None
+    return create_video_thumbnail(file_path, size=THUMBNAIL_SIZE)
 
 
 def apply_exif_orientation(image):
-    """Apply the EXIF orientation to the image"""
+    """Apply the EXIF orientation to the image (in place, one transpose for any orientation)"""
     try:
-        exif = image._getexif()
-        if exif is None:
-            return image
-            
-        orientation_key = next((key for key, value in TAGS.items() if value == 'Orientation'), None)
-        if orientation_key is None or orientation_key not in exif:
-            return image
-            
-        orientation = exif[orientation_key]
-        
-        # Orientation values and their corresponding transformations:
-        # 1: Normal (no rotation, no flip)
-        # 2: Mirrored horizontally
-        # 3: Rotated 180 degrees
-        # 4: Mirrored vertically
-        # 5: Mirrored horizontally and rotated 90 degrees counter-clockwise
-        # 6: Rotated 90 degrees counter-clockwise
-        # 7: Mirrored horizontally and rotated 90 degrees clockwise
-        # 8: Rotated 90 degrees clockwise
-        
-        if orientation == 1:
-            return image
-        elif orientation == 2:
-            return image.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 3:
-            return image.transpose(Image.ROTATE_180)
-        elif orientation == 4:
-            return image.transpose(Image.FLIP_TOP_BOTTOM)
-        elif orientation == 5:
-            return image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90)
-        elif orientation == 6:
-            return image.transpose(Image.ROTATE_270)
-        elif orientation == 7:
-            return image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
-        elif orientation == 8:
-            return image.transpose(Image.ROTATE_90)
-        return image
+        ImageOps.exif_transpose(image, in_place=True)
     except Exception as e:
         print(f"Error applying EXIF orientation: {e}")
-        return image
+    return image
 
 
-def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
-    """Process a single media file completely (thumbnailing and uploading)"""
+def process_file(
+    file_path: str, dry_run: bool = False, exiftool_date: datetime = None, file_size: Optional[int] = None
+) -> Dict[str, Any]:
+    """Prepare a single media file for upload (dating, optimizing, thumbnailing)
+
+    The objects to store are returned as result["uploads"], a list of
+    (key, bytes, content_type), for the upload stage in upload_photos to send;
+    dry runs leave it empty. exiftool_date is this file's date as already read by
+    ExifToolDaemon, if any, and file_size its size from the directory scan
+    (the file is stat'ed here otherwise).
+    """
     file_name = os.path.basename(file_path)
-    file_lower = file_name.lower()
+    file_ext = file_extension(file_name)
     result = {
         "file_path": file_path, 
         "file_name": file_name,
@@ -226,19 +337,41 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
         "error": None
     }
     
-    # Validate file exists
-    if not os.path.exists(file_path):
-        result["error"] = f"File not found: {file_path}"
-        return result
-    
-    # Get file size only after confirming it exists
-    file_size = os.path.getsize(file_path)
+    # Validate file exists (one stat, and none when the size is already known)
+    if file_size is None:
+        try:
+            file_size = os.stat(file_path).st_size
+        except FileNotFoundError:
+            result["error"] = f"File not found: {file_path}"
+            return result
     result["file_size"] = file_size
 
     try:
+        # Process based on file type
+        is_video = file_ext in VIDEO_EXTENSIONS
+
+        # Read images into memory once; the content hash and the decode both
+        # use these bytes instead of reading the file twice
+        image_data = None
+        if not is_video and file_size <= MAX_IMAGE_READ_BYTES:
+            with open(file_path, "rb") as f:
+                image_data = f.read()
+
+        # Open images once; the date, main sizes and thumbnail all come from it.
+        # HEIC is fully decoded on opening and is dated through exiftool, so it
+        # is only opened once the stored-keys check below has passed.
+        open_later = file_ext in HEIC_EXTENSIONS
+        image = None
+        if not is_video and not open_later:
+            try:
+                image = open_main_image(file_path, image_data)
+            except Exception as e:
+                result["error"] = f"Invalid image: Error validating image: {e.__class__.__name__}: {e}"
+                return result
+
         # Get full datetime from metadata
         try:
-            date_obj = get_exif_date(file_path, VIDEO_EXTENSIONS, IMAGE_EXTENSIONS)
+            date_obj = get_exif_date(file_path, VIDEO_EXTENSIONS, IMAGE_EXTENSIONS, exiftool_date, image)
             year, month = date_obj.year, date_obj.month
             # Also store full timestamp for later use
             timestamp = date_obj.isoformat()
@@ -246,21 +379,58 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
             result["error"] = f"Error getting date: {e}"
             return result
 
-        # Generate a unique filename based on content hash
-        with open(file_path, "rb") as f:
-            file_hash = hashlib.md5(f.read()).hexdigest()[:10]
+        # Generate a unique filename based on content hash; videos and very
+        # large images are streamed in chunks rather than held in memory.
+        # Stays MD5 so keys match what is already in the bucket; it is only a
+        # name, not a security check.
+        if image_data is not None:
+            file_hash = hashlib.md5(image_data, usedforsecurity=False).hexdigest()[:10]
+        else:
+            with open(file_path, "rb", buffering=0) as f:
+                file_hash = hashlib.file_digest(f, partial(hashlib.md5, usedforsecurity=False)).hexdigest()[:10]
+
+        # Everything this file would produce is already in the bucket (e.g. a
+        # run was interrupted before caching it): skip decoding and encoding.
+        # The date and keys are still returned, so metadata.json and the
+        # manifest pick the file up if one of them is missing it. Files that
+        # neither lists are re-encoded for their dimensions and blur hash
+        # (their objects are still not sent again).
+        if is_video:
+            stored_sizes = {}
+            stored_media_key = f"media/{year}/{month:02d}/{file_hash}.mp4"
+        else:
+            stored_sizes = {
+                size_name: f"media/{year}/{month:02d}/{file_hash}_{size_name}.webp" for size_name in IMAGE_SIZES
+            }
+            stored_media_key = stored_sizes["large"]
+        output_keys = [stored_media_key, *stored_sizes.values(), f"thumbnails/{year}/{month:02d}/{file_hash}.webp"]
+        if stored_media_key in RECORDED_KEYS and STORED_KEYS.issuperset(output_keys):
+            result["timestamp"] = timestamp
+            result["media_key"] = stored_media_key
+            result["file_hash"] = file_hash
+            result["media_sizes"] = stored_sizes
+            result["media_dimensions"] = {}
+            result["year"] = year
+            result["month"] = month
+            result["blur_hash"] = None
+            result["already_stored"] = True
+            result["success"] = True
+            return result
 
-        # Process based on file type
-        is_heic = any(file_lower.endswith(ext) for ext in (".heic", ".heif"))
-        is_video = any(file_lower.endswith(ext) for ext in VIDEO_EXTENSIONS)
+        if open_later:
+            try:
+                image = open_main_image(file_path, image_data)
+            except Exception as e:
+                result["error"] = f"Invalid image: Error validating image: {e.__class__.__name__}: {e}"
+                return result
 
         # Validate video files before processing
         if is_video:
-            is_valid, validation_msg = validate_video_file(file_path)
+            # One ffprobe run both validates the video and reads its limits
+            is_valid, validation_msg, duration, size_mb = probe_video(file_path)
             
             # Check if video exceeds size or duration limits
             if is_valid:
-                duration, size_mb = get_video_metadata(file_path)
                 if duration is not None and duration > MAX_VIDEO_DURATION_SECONDS:
                     is_valid = False
                     validation_msg = f"Video too long: {duration:.2f}s (max {MAX_VIDEO_DURATION_SECONDS}s)"
@@ -272,18 +442,13 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
             if not is_valid:
                 result["error"] = f"Invalid video: {validation_msg}"
                 return result
-                
-        # Validate image files
-        elif not is_video:
-            # Validate non-HEIC images (HEIC gets special handling during conversion)
-            if not is_heic:
-                is_valid_img, img_msg = validate_image_file(file_path)
-                if not is_valid_img:
-                    result["error"] = f"Invalid image: {img_msg}"
-                    return result
-
-        # Get the thread-local MinIO client if needed
-        minio_client = None if dry_run else get_minio_client()
+
+        # Objects to store, handed back to the upload stage as bytes
+        uploads = []
+
+        def upload(key, buffer, content_type):
+            if not dry_run:
+                uploads.append((key, buffer.getvalue(), content_type))
         
         # Initialize blurhash
         blur_hash = None
@@ -292,46 +457,28 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
         media_key = None
         media_sizes = {}
         media_dimensions = {}
+        thumb_buffer = None
         
         if is_video:
             # For videos, optimize and upload
-            optimized_buffer = optimize_video(file_path)
-            if optimized_buffer:
+            optimized_video = optimize_video(file_path)
+            if optimized_video:
                 media_key = f"media/{year}/{month:02d}/{file_hash}.mp4"
-                media_size = optimized_buffer.getbuffer().nbytes
-                
+                media_bytes = len(optimized_video)
                 if not dry_run:
-                    minio_client.put_object(
-                        BUCKET_NAME,
-                        media_key,
-                        optimized_buffer,
-                        media_size,
-                        content_type="video/mp4",
-                    )
+                    uploads.append((media_key, optimized_video, "video/mp4"))
             else:
                 result["error"] = "Failed to optimize video"
                 return result
         else:
-            # For images, create optimized version in multiple sizes
-            size_buffers, size_dims = create_main_image(file_path)
+            # For images, create optimized version in multiple sizes, then
+            # the thumbnail, from the one decoded image
+            image = apply_exif_orientation(image)
+            size_buffers, size_dims, thumb_buffer = create_image_outputs(image, file_path)
             if size_buffers:
                 # Use 'large' as the primary media_key for backward compatibility
                 media_key = f"media/{year}/{month:02d}/{file_hash}_large.webp"
-                
-                for size_name, buffer in size_buffers.items():
-                    current_key = f"media/{year}/{month:02d}/{file_hash}_{size_name}.webp"
-                    current_size = buffer.getbuffer().nbytes
-                    media_sizes[size_name] = current_key
-                    media_dimensions[size_name] = size_dims[size_name]
-                    
-                    if not dry_run:
-                        minio_client.put_object(
-                            BUCKET_NAME,
-                            current_key,
-                            buffer,
-                            current_size,
-                            content_type="image/webp",
-                        )
+                media_bytes = 0
                 
                 # Generate BlurHash from the large buffer
                 large_buffer = size_buffers.get("large")
@@ -339,21 +486,24 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
                     large_buffer.seek(0)
                     blur_hash = generate_blurhash(large_buffer)
                     large_buffer.seek(0)
+                
+                for size_name, buffer in size_buffers.items():
+                    current_key = f"media/{year}/{month:02d}/{file_hash}_{size_name}.webp"
+                    current_size = buffer.getbuffer().nbytes
+                    media_bytes += current_size
+                    media_sizes[size_name] = current_key
+                    media_dimensions[size_name] = size_dims[size_name]
+                    upload(current_key, buffer, "image/webp")
             else:
                 result["error"] = "Failed to create optimized images"
                 return result
 
-        # Create and upload thumbnail
-        # Skip thumbnail creation if video validation failed or image is invalid
-        if is_video and (not is_valid):
-            result["error"] = "Skipping thumbnail for invalid video"
-            return result
-
-        # Create thumbnail
-        thumb_buffer = create_thumbnail(file_path)
+        # Create and upload thumbnail (invalid videos and images have already
+        # returned above; image thumbnails come from create_image_outputs)
+        if is_video:
+            thumb_buffer = create_thumbnail(file_path)
         if thumb_buffer:
             thumbnail_key = f"thumbnails/{year}/{month:02d}/{file_hash}.webp"
-            thumb_size = thumb_buffer.getbuffer().nbytes
             
             # If we didn't get a blurhash from the main image (e.g. video), 
             # try to get it from the thumbnail
@@ -362,14 +512,7 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
                 blur_hash = generate_blurhash(thumb_buffer)
                 thumb_buffer.seek(0)
             
-            if not dry_run:
-                minio_client.put_object(
-                    BUCKET_NAME,
-                    thumbnail_key,
-                    thumb_buffer,
-                    thumb_size,
-                    content_type="image/webp",
-                )
+            upload(thumbnail_key, thumb_buffer, "image/webp")
         else:
             result["error"] = "Thumbnail creation failed"
             return result
@@ -377,11 +520,14 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
         # Add timestamp to the result for manifest generation later
         result["timestamp"] = timestamp
         result["media_key"] = media_key
+        result["file_hash"] = file_hash
+        result["media_bytes"] = media_bytes
         result["media_sizes"] = media_sizes
         result["media_dimensions"] = media_dimensions
         result["year"] = year
         result["month"] = month
         result["blur_hash"] = blur_hash
+        result["uploads"] = uploads
         
         result["success"] = True
         return result
@@ -391,6 +537,33 @@ def process_file(file_path: str, dry_run: bool = False) -> Dict[str, Any]:
         return result
 
 
+def list_media_objects(minio_client, prefix="media/"):
+    """List every object under prefix, one recursive listing per year in parallel
+
+    A single recursive listing pages through the whole bucket serially; the
+    year prefixes are independent, so their pages are fetched concurrently.
+    """
+    prefixes = []
+    objects = []
+    for obj in minio_client.list_objects(BUCKET_NAME, prefix=prefix, recursive=False):
+        if obj.is_dir:
+            prefixes.append(obj.object_name)
+        else:
+            objects.append(obj)
+
+    def list_prefix(year_prefix):
+        return list(minio_client.list_objects(BUCKET_NAME, prefix=year_prefix, recursive=True))
+
+    if not prefixes:
+        return objects
+
+    # One thread per year, up to the client's default connection pool size
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(prefixes), MAX_WORKERS_THREAD)) as executor:
+        for prefix_objects in executor.map(list_prefix, prefixes):
+            objects.extend(prefix_objects)
+    return objects
+
+
 def generate_manifest(minio_client):
     """
     Generate a manifest.json file containing metadata for all photos in the bucket.
@@ -401,29 +574,31 @@ def generate_manifest(minio_client):
         # Load metadata.json
         metadata = {"files": {}}
         try:
-            minio_client.stat_object(BUCKET_NAME, "metadata.json")
-            temp_file = tempfile.NamedTemporaryFile(delete=False)
-            minio_client.fget_object(BUCKET_NAME, "metadata.json", temp_file.name)
-            with open(temp_file.name, 'r') as f:
-                metadata = json.load(f)
-            os.unlink(temp_file.name)
+            response = minio_client.get_object(BUCKET_NAME, "metadata.json")
+            try:
+                metadata = json.loads(response.read())
+            finally:
+                response.close()
+                response.release_conn()
         except Exception:
             pass
         
         # List all objects in media/
-        objects = list(minio_client.list_objects(BUCKET_NAME, prefix="media/", recursive=True))
+        objects = list_media_objects(minio_client)
         
         # Group objects by content hash (the part before the size suffix)
         photo_entries = {}
         
         for obj in objects:
-            path_parts = obj.object_name.split("/")
-            if len(path_parts) < 4:
+            # One match per key; anything not laid out as media/YEAR/MONTH/
+            # FILENAME is skipped rather than failing the whole manifest
+            match = MEDIA_KEY_RE.match(obj.object_name)
+            if not match:
                 continue
                 
-            year = int(path_parts[1])
-            month = int(path_parts[2])
-            full_filename = path_parts[3]
+            year = int(match[1])
+            month = int(match[2])
+            full_filename = match[3]
             
             # Determine base filename and size if applicable
             # Example: hash123_small.webp -> base: hash123, size: small
@@ -497,40 +672,7 @@ def generate_manifest(minio_client):
             
             final_photos.append(entry)
 
-        # Sort photos by timestamp
-        final_photos.sort(key=lambda p: (
-            p["timestamp"] if p["timestamp"] else f"{p['year']}-{p['month']:02d}-01T00:00:00",
-            p["year"], 
-            p["month"],
-            p["id"]
-        ))
-
-        # Generate timeline data
-        year_counts = {}
-        for photo in final_photos:
-            year = photo["year"]
-            year_counts[year] = year_counts.get(year, 0) + 1
-
-        timeline = [{"year": year, "count": count} for year, count in year_counts.items()]
-        timeline.sort(key=lambda x: x["year"])
-
-        # Create the manifest
-        manifest = {
-            "photos": final_photos,
-            "timeline": timeline,
-            "generated_at": datetime.now().isoformat(),
-            "total_photos": len(final_photos),
-        }
-
-        # Save and upload manifest
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as temp_file:
-            json.dump(manifest, temp_file, indent=2)
-            temp_file_path = temp_file.name
-
-        minio_client.fput_object(BUCKET_NAME, "manifest.json", temp_file_path, content_type="application/json")
-        os.unlink(temp_file_path)
-
-        print(f"✓ Manifest uploaded with {len(final_photos)} photos")
+        upload_manifest(minio_client, final_photos)
         return True
 
     except Exception as e:
@@ -540,8 +682,238 @@ def generate_manifest(minio_client):
         return False
 
 
-def upload_photos(photos_dir: str, dry_run=False, dedupe=False, threshold=5, skip_invalid=True):
-    """Upload photos and videos to MinIO with year/month structure using parallel processing"""
+def upload_manifest(minio_client, photos: List[Dict[str, Any]]):
+    """Sort photos, add the timeline and upload them as manifest.json"""
+    # Sort photos by timestamp
+    photos.sort(key=lambda p: (
+        p["timestamp"] if p["timestamp"] else f"{p['year']}-{p['month']:02d}-01T00:00:00",
+        p["year"], 
+        p["month"],
+        p["id"]
+    ))
+
+    # Generate timeline data
+    year_counts = Counter(photo["year"] for photo in photos)
+    timeline = [{"year": year, "count": count} for year, count in year_counts.items()]
+    timeline.sort(key=lambda x: x["year"])
+
+    # Write the manifest as compact JSON one photo at a time into a gzip
+    # stream, so the uncompressed document is never held in memory; browsers
+    # decode it transparently via the Content-Encoding header
+    dumps = partial(json.dumps, separators=(",", ":"))
+    manifest_buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=manifest_buffer, mode="wb", compresslevel=6, mtime=0) as gz:
+        gz.write(b'{"photos":[')
+        for i, photo in enumerate(photos):
+            if i:
+                gz.write(b",")
+            gz.write(dumps(photo).encode("utf-8"))
+        gz.write(
+            f'],"timeline":{dumps(timeline)},'
+            f'"generated_at":{dumps(datetime.now().isoformat())},'
+            f'"total_photos":{len(photos)}}}'.encode("utf-8")
+        )
+
+    manifest_size = manifest_buffer.tell()
+    manifest_buffer.seek(0)
+    minio_client.put_object(
+        BUCKET_NAME,
+        "manifest.json",
+        manifest_buffer,
+        manifest_size,
+        content_type="application/json",
+        metadata={"Content-Encoding": "gzip"},
+    )
+
+    print(f"✓ Manifest uploaded with {len(photos)} photos")
+
+
+def manifest_entry(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Build a manifest photo entry from a successful process_file result"""
+    year, month = result["year"], result["month"]
+    media_key = result["media_key"]
+    return {
+        "id": f"media/{year}/{month:02d}/{result['file_hash']}",
+        "year": year,
+        "month": month,
+        "filename": media_key.rsplit("/", 1)[1],
+        "path": media_key,
+        "sizes": dict(result["media_sizes"]),
+        "dimensions": dict(result["media_dimensions"]),
+        "timestamp": result["timestamp"],
+        "blur_hash": result["blur_hash"],
+        "size": result["media_bytes"],
+    }
+
+
+def read_metadata(minio_client) -> Dict[str, Any]:
+    """Read metadata.json straight into memory (there is none yet on the first run)"""
+    try:
+        response = minio_client.get_object(BUCKET_NAME, "metadata.json")
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+    except S3Error as e:
+        if e.code != "NoSuchKey":
+            raise
+        return {"files": {}}
+
+
+def read_manifest_photos(minio_client) -> List[Dict[str, Any]]:
+    """Read the photo entries of the existing manifest.json"""
+    response = minio_client.get_object(BUCKET_NAME, "manifest.json")
+    try:
+        data = response.read()
+    finally:
+        response.close()
+        response.release_conn()
+    # urllib3 may already have undone the gzip Content-Encoding
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    return json.loads(data)["photos"]
+
+
+def update_manifest(minio_client, results: List[Dict[str, Any]], metadata: Optional[Dict[str, Any]] = None):
+    """Merge this run's uploads into the existing manifest.json
+
+    The uploader already knows everything about the files it just stored, so
+    the bucket is only listed (via generate_manifest) when there is no readable
+    manifest to merge into. Use --manifest-only to rebuild it from the bucket.
+    Files that were already stored but are missing from the manifest take
+    their dimensions and blur hash from metadata (the contents of metadata.json).
+    """
+    print("Updating manifest file...")
+    try:
+        photos = read_manifest_photos(minio_client)
+    except Exception as e:
+        print(f"Could not read existing manifest ({e}), regenerating from the bucket")
+        return generate_manifest(minio_client)
+
+    metadata_files = (metadata or {}).get("files", {})
+    photos_by_id = {photo["id"]: photo for photo in photos}
+    for result in results:
+        if result.get("success") and result.get("media_key"):
+            entry = manifest_entry(result)
+            if result.get("already_stored"):
+                existing = photos_by_id.get(entry["id"])
+                if existing is not None:
+                    # Not re-encoded this run, so the existing entry's blur
+                    # hash and dimensions are kept
+                    if not existing.get("timestamp"):
+                        existing["timestamp"] = entry["timestamp"]
+                    continue
+                meta = metadata_files.get(result["media_key"], {})
+                if meta.get("blur_hash"): entry["blur_hash"] = meta["blur_hash"]
+                if meta.get("media_dimensions"): entry["dimensions"].update(meta["media_dimensions"])
+            photos_by_id[entry["id"]] = entry
+
+    try:
+        upload_manifest(minio_client, list(photos_by_id.values()))
+        return True
+    except Exception as e:
+        print(f"Error updating manifest: {e}")
+        return False
+
+
+def open_upload_cache(cache_path):
+    """Open (creating if needed) the SQLite cache of files already uploaded to MinIO"""
+    conn = sqlite3.connect(cache_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS uploads ("
+        "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, media_key TEXT)"
+    )
+    return conn
+
+
+def upload_cache_key(file_path, st=None):
+    """Cache key for a file: it is uploaded again whenever its path, mtime or size changes"""
+    if st is None:
+        st = os.stat(file_path)
+    return os.path.abspath(file_path), st.st_mtime_ns, st.st_size
+
+
+def walk_media(root):
+    """Yield (path, stat_result) for every media file under root in a single scandir pass"""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                name = entry.name.lower()
+                if name in SKIP_FILES or file_extension(name) not in MEDIA_EXTENSIONS:
+                    continue
+                # Also skips broken symlinks and special files, which would
+                # otherwise fail later on stat or open
+                if entry.is_file():
+                    yield entry.path, entry.stat()
+
+
+def drop_identical_files(files, file_stats):
+    """Drop files that are byte-identical copies of an earlier file in the list
+
+    Only files sharing their size with another file are read and hashed, so a
+    library without copies costs a single pass over the stat results.
+    """
+    by_size = {}
+    for file_path in files:
+        by_size.setdefault(file_stats[file_path].st_size, []).append(file_path)
+    candidates = [file_path for group in by_size.values() if len(group) > 1 for file_path in group]
+    if not candidates:
+        return files
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS_THREAD) as executor:
+        digests = dict(zip(candidates, executor.map(content_digest, candidates)))
+
+    seen = set()
+    copies = set()
+    for file_path in candidates:
+        digest = digests[file_path]
+        if digest is None:
+            continue
+        key = (file_stats[file_path].st_size, digest)
+        if key in seen:
+            copies.add(file_path)
+        else:
+            seen.add(key)
+    return [file_path for file_path in files if file_path not in copies]
+
+
+def estimated_memory(file_path, file_size):
+    """Rough peak memory to prepare a file: decoded pixels dwarf the compressed
+    size for images, while ffmpeg streams videos"""
+    return file_size * (2 if file_extension(file_path) in VIDEO_EXTENSIONS else 8)
+
+
+def prefetch_file(file_path):
+    """Ask the kernel to start reading a file into the page cache in the background
+
+    Files are queued ahead of the workers, so their disk reads overlap with
+    the processing of earlier files. No-op where posix_fadvise is unavailable.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def upload_photos(photos_dir: str, dry_run=False, dedupe=False, threshold=5, skip_invalid=True, cache_path=UPLOAD_CACHE_PATH):
+    """Upload photos and videos to MinIO with year/month structure using parallel processing
+
+    Unless cache_path is None, files recorded there as uploaded (and unchanged
+    since) are skipped, and newly uploaded files are added to it once
+    metadata.json and the manifest list them. Dry runs neither read nor write
+    the cache.
+    """
     if dry_run:
         print(f"DRY RUN: Testing media processing from {photos_dir} (no uploads will occur)")
     else:
@@ -549,30 +921,37 @@ def upload_photos(photos_dir: str, dry_run=False, dedupe=False, threshold=5, ski
         minio_client = setup_minio_client()
         ensure_bucket_exists(minio_client)
 
-    # Initialize mimetypes
-    mimetypes.init()
+    # JPEG decode dominates the image path; a plain libjpeg build is several
+    # times slower than libjpeg-turbo (bundled with the Pillow wheels)
+    if features.check_feature("libjpeg_turbo"):
+        print(f"JPEG codec: libjpeg-turbo {features.version_feature('libjpeg_turbo')}")
+    else:
+        print(f"Warning: Pillow {features.version('pil')} is not built with libjpeg-turbo; JPEG decoding will be slow")
+
+    # First, collect all eligible files along with their stat results, which
+    # serve the size, dedupe and cache lookups below without stat'ing again
+    file_stats = dict(walk_media(photos_dir))
+    eligible_files = list(file_stats)
 
-    # First, collect all eligible files
-    eligible_files = []
-    for root, _, files in os.walk(photos_dir):
-        for file in files:
-            file_lower = file.lower()
-            if (
-                any(file_lower.endswith(ext) for ext in IMAGE_EXTENSIONS)
-                or any(file_lower.endswith(ext) for ext in VIDEO_EXTENSIONS)
-            ) and not any(file_lower.endswith(skip) for skip in SKIP_FILES):
-                eligible_files.append(os.path.join(root, file))
+    # Exact copies would produce the same objects, so only the first is kept
+    unique_files = drop_identical_files(eligible_files, file_stats)
+    if len(unique_files) < len(eligible_files):
+        print(f"Skipping {len(eligible_files) - len(unique_files)} byte-identical copies")
+        eligible_files = unique_files
 
     # Apply deduplication if enabled
     if dedupe:
         print(f"Applying deduplication with threshold {threshold}...")
         
         # Separate images and videos
-        image_files = [f for f in eligible_files if any(f.lower().endswith(ext) for ext in IMAGE_EXTENSIONS)]
-        video_files = [f for f in eligible_files if any(f.lower().endswith(ext) for ext in VIDEO_EXTENSIONS)]
+        image_files = [f for f in eligible_files if file_extension(f) in IMAGE_EXTENSIONS]
+        video_files = [f for f in eligible_files if file_extension(f) in VIDEO_EXTENSIONS]
         
         # Only deduplicate images, keep all videos
-        unique_images = filter_duplicates(image_files, threshold, skip_invalid)
+        unique_images = filter_duplicates(
+            image_files, threshold, skip_invalid,
+            ctimes={f: file_stats[f].st_ctime for f in image_files},
+        )
         
         # Record original count for reporting
         original_count = len(eligible_files)
@@ -582,58 +961,206 @@ def upload_photos(photos_dir: str, dry_run=False, dedupe=False, threshold=5, ski
         
         print(f"After deduplication: {len(eligible_files)} of {original_count} files will be processed")
 
+    # Skip files uploaded by an earlier run (after deduplication, so new
+    # near-duplicates of already uploaded photos are still filtered out)
+    cache = open_upload_cache(cache_path) if cache_path and not dry_run else None
+    cache_keys = {}
+    if cache is not None:
+        to_upload = []
+        for file_path in eligible_files:
+            cache_keys[file_path] = key = upload_cache_key(file_path, file_stats[file_path])
+            row = cache.execute(
+                "SELECT 1 FROM uploads WHERE path = ? AND mtime_ns = ? AND size = ?", key
+            ).fetchone()
+            if not row:
+                to_upload.append(file_path)
+        print(f"{len(eligible_files) - len(to_upload)} cached, {len(to_upload)} to upload")
+        eligible_files = to_upload
+
     total_files = len(eligible_files)
     if total_files == 0:
         print("No media files found to upload")
         return
 
+    # Objects already in the bucket (e.g. uploaded from another machine, or
+    # before the cache existed) are not sent again. Listing once up front is
+    # far cheaper than a HEAD request per object.
+    stored_keys = {}  # key -> size
+    if not dry_run:
+        try:
+            stored_keys = {
+                obj.object_name: obj.size
+                for prefix in ("media/", "thumbnails/")
+                for obj in list_media_objects(minio_client, prefix)
+            }
+        except Exception as e:
+            print(f"Warning: could not list existing objects ({e}); uploading everything")
+
+    # Stored files are only skipped if metadata.json or the manifest already
+    # lists them, so their dimensions and blur hash are known
+    metadata = None
+    recorded_photos = {}  # media key -> manifest entry
+    if stored_keys:
+        try:
+            metadata = read_metadata(minio_client)
+        except Exception as e:
+            print(f"Warning: could not read metadata.json ({e})")
+        try:
+            recorded_photos = {photo["path"]: photo for photo in read_manifest_photos(minio_client)}
+        except Exception:
+            pass  # No manifest yet, or it is rebuilt from the bucket at the end
+    recorded_keys = set(recorded_photos)
+    if metadata is not None:
+        recorded_keys.update(metadata["files"])
+
     # Calculate total size for progress tracking
-    total_size = sum(os.path.getsize(f) for f in eligible_files)
+    total_size = sum(file_stats[f].st_size for f in eligible_files)
     print(f"Found {total_files} media files to process (Total: {total_size / (1024*1024):.2f} MB)")
 
+    # Read dates for all HEIC files through one exiftool process now, rather
+    # than starting exiftool per file inside the workers. Videos are dated by
+    # ffprobe and only fall back to exiftool, so they are left out.
+    exiftool_files = [
+        f for f in eligible_files
+        if file_extension(f) in HEIC_EXTENSIONS
+    ]
+    exiftool_dates = {}
+    if exiftool_files:
+        try:
+            with ExifToolDaemon() as exiftool:
+                exiftool_dates = exiftool.get_dates(exiftool_files)
+        except OSError as e:
+            print(f"Warning: could not start exiftool, dates will be read per file: {e}")
+
     # Create progress bar for overall progress
-    progress_bar = tqdm(total=total_size, desc="Overall progress", unit="B", unit_scale=True)
+    # Redraw at most twice a second; with many small files the bar would
+    # otherwise re-render after nearly every one
+    progress_bar = tqdm(
+        total=total_size, desc="Overall progress", unit="B", unit_scale=True,
+        mininterval=0.5, smoothing=0.1,
+    )
     
     # Process files in parallel
     results = []
     error_files = []
+    cache_rows = []  # Upload cache rows, written once metadata and manifest are saved
     
     # Create a partial function with dry_run parameter
     process_file_with_dryrun = partial(process_file, dry_run=dry_run)
     
-    # Use ProcessPoolExecutor for CPU-bound processing (thumbnails, image processing)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS_PROCESS) as executor:
-        # Process files in parallel
-        future_to_file = {executor.submit(process_file_with_dryrun, file_path): file_path for file_path in eligible_files}
-        
-        for future in concurrent.futures.as_completed(future_to_file):
-            file_path = future_to_file[future]
-            file_size = os.path.getsize(file_path)
-            
-            try:
-                result = future.result()
+    # Two-stage pipeline: worker processes do the CPU-bound preparation
+    # (decoding, resizing, encoding) while upload threads in this process send
+    # each prepared object as its own PUT, so CPU and network work overlap and
+    # a file's sizes and thumbnail upload in parallel. At most
+    # MAX_IN_FLIGHT_FILES, within MAX_IN_FLIGHT_BYTES of estimated memory, are
+    # queued or buffered at once.
+    files_to_submit = iter(eligible_files)
+    next_file = next(files_to_submit, None)
+    pending = {}  # future -> file path, for both stages
+    uploading = {}  # file path -> [result, objects still uploading]
+    in_flight = {}  # file path -> estimated memory to prepare it
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=MAX_WORKERS_PROCESS,
+        initializer=init_worker,
+        initargs=(SKIP_VIDEO_THUMBNAILS, frozenset(stored_keys), frozenset(recorded_keys)),
+    ) as executor, concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS_THREAD) as upload_executor:
+
+        def fill_pipeline():
+            """Submit files until the file or memory limit is reached (one
+            file is always let through, however large)"""
+            nonlocal next_file
+            while next_file is not None and len(in_flight) < MAX_IN_FLIGHT_FILES:
+                estimate = estimated_memory(next_file, file_stats[next_file].st_size)
+                if in_flight and MAX_IN_FLIGHT_BYTES is not None and sum(in_flight.values()) + estimate > MAX_IN_FLIGHT_BYTES:
+                    return
+                prefetch_file(next_file)
+                future = executor.submit(
+                    process_file_with_dryrun, next_file,
+                    exiftool_date=exiftool_dates.get(next_file), file_size=file_stats[next_file].st_size,
+                )
+                pending[future] = next_file
+                in_flight[next_file] = estimate
+                next_file = next(files_to_submit, None)
+
+        fill_pipeline()
+
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                file_path = pending.pop(future)
+                file_size = file_stats[file_path].st_size
+
+                if file_path in uploading:
+                    # One of the file's objects finished uploading
+                    state = uploading[file_path]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        if state[0]["success"]:
+                            state[0]["success"] = False
+                            state[0]["error"] = f"Upload error: {e.__class__.__name__}: {e}"
+                    state[1] -= 1
+                    if state[1]:
+                        continue
+                    result = uploading.pop(file_path)[0]
+                else:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        error_files.append((file_path, f"Processing error: {e}"))
+                        progress_bar.update(file_size)
+                        del in_flight[file_path]
+                        fill_pipeline()
+                        continue
+
+                    if result.get("already_stored"):
+                        # Sized from the listing, for the manifest entry
+                        if result["media_sizes"]:
+                            media_keys = result["media_sizes"].values()
+                        else:
+                            media_keys = [result["media_key"]]  # Videos are a single object
+                        result["media_bytes"] = sum(stored_keys[key] for key in media_keys)
+
+                    # Prepared but not yet stored: hand its objects to the upload stage
+                    uploads = [
+                        upload for upload in result.pop("uploads", None) or ()
+                        if upload[0] not in stored_keys
+                    ]
+                    if uploads:
+                        uploading[file_path] = [result, len(uploads)]
+                        for key, data, content_type in uploads:
+                            upload_future = upload_executor.submit(
+                                upload_buffer, key, io.BytesIO(data), len(data), content_type
+                            )
+                            pending[upload_future] = file_path
+                        continue
+
                 results.append(result)
                 
                 if result.get("error"):
                     error_files.append((file_path, result["error"]))
-                
+                elif cache is not None and result.get("success"):
+                    cache_rows.append((*cache_keys[file_path], result["media_key"]))
+
                 # Update progress bar
                 progress_bar.update(file_size)
-                
-            except Exception as e:
-                error_files.append((file_path, f"Processing error: {e}"))
-                progress_bar.update(file_size)
+                del in_flight[file_path]
+                fill_pipeline()
 
     progress_bar.close()
     
     # Calculate success statistics
     success_count = sum(1 for r in results if r.get("success", False))
-    processed_size = sum(r.get("file_size", 0) for r in results if r.get("success", False))
+    stored_count = sum(1 for r in results if r.get("already_stored"))
+    processed_size = sum(
+        r.get("file_size", 0) for r in results if r.get("success", False) and not r.get("already_stored")
+    )
     
     if dry_run:
         print(f"Dry run completed: Successfully processed {success_count} of {total_files} media files")
     else:
-        print(f"Uploaded {success_count} of {total_files} media files to MinIO")
+        print(f"Uploaded {success_count} of {total_files} media files to MinIO ({stored_count} were already stored)")
         print(f"Total data transferred: {processed_size / (1024*1024):.2f} MB")
 
     # Report errors
@@ -645,170 +1172,133 @@ def upload_photos(photos_dir: str, dry_run=False, dedupe=False, threshold=5, ski
         print("No errors found. All files processed successfully.")
 
     # Generate and upload the manifest file
+    metadata_saved = manifest_saved = False
     if not dry_run and success_count > 0:
         # Store detailed metadata for uploaded files to allow proper sorting
         if any(r.get("timestamp") for r in results if r.get("success", False)):
             # To store metadata about processed files - create or update metadata files
             try:
-                # First check if metadata.json exists
-                metadata_exists = False
-                try:
-                    minio_client.stat_object(BUCKET_NAME, "metadata.json")
-                    metadata_exists = True
-                except Exception:
-                    pass
-                
-                if metadata_exists:
-                    # Get existing metadata
-                    temp_file = tempfile.NamedTemporaryFile(delete=False)
-                    minio_client.fget_object(BUCKET_NAME, "metadata.json", temp_file.name)
-                    with open(temp_file.name, 'r') as f:
-                        metadata = json.load(f)
-                else:
-                    metadata = {"files": {}}
+                # Reuse the metadata read before processing, if any
+                if metadata is None:
+                    metadata = read_metadata(minio_client)
                 
                 # Add metadata from successful uploads
                 for result in results:
                     if result.get("success") and result.get("media_key") and result.get("timestamp"):
+                        blur_hash = result.get("blur_hash")
+                        media_dimensions = result.get("media_dimensions", {})
+                        if result.get("already_stored"):
+                            if result["media_key"] in metadata["files"]:
+                                continue  # Recorded when it was uploaded
+                            # Otherwise the manifest lists it (see RECORDED_KEYS)
+                            photo = recorded_photos[result["media_key"]]
+                            blur_hash = photo.get("blur_hash")
+                            media_dimensions = photo.get("dimensions", {})
                         metadata["files"][result["media_key"]] = {
                             "timestamp": result["timestamp"],
                             "year": result["year"],
                             "month": result["month"],
-                            "blur_hash": result.get("blur_hash"),
+                            "blur_hash": blur_hash,
                             "media_sizes": result.get("media_sizes", {}),
-                            "media_dimensions": result.get("media_dimensions", {})
+                            "media_dimensions": media_dimensions
                         }
                 
-                # Write updated metadata back
-                with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as temp_file:
-                    json.dump(metadata, temp_file, indent=2)
-                    metadata_file_path = temp_file.name
-                
-                # Upload metadata
-                minio_client.fput_object(
+                # Write updated metadata back as compact JSON from memory
+                metadata_bytes = json.dumps(metadata, separators=(",", ":")).encode("utf-8")
+                minio_client.put_object(
                     BUCKET_NAME,
                     "metadata.json",
-                    metadata_file_path,
+                    io.BytesIO(metadata_bytes),
+                    len(metadata_bytes),
                     content_type="application/json"
                 )
                 
-                # Clean up temporary file
-                os.unlink(metadata_file_path)
-                
+                metadata_saved = True
                 print("✓ Detailed metadata saved")
             except Exception as e:
                 print(f"Warning: Failed to store detailed metadata: {e}")
                 
-        # Generate the manifest
-        generate_manifest(get_minio_client())
-
-
-def filter_duplicates(image_files: List[str], threshold: int = 5, skip_invalid: bool = True) -> List[str]:
+        # Add this run's uploads to the manifest
+        manifest_saved = update_manifest(get_minio_client(), results, metadata)
+
+    # Only files that made it into metadata.json and the manifest are cached
+    # as done; otherwise an interrupted or failed run would leave them stored
+    # but never listed, and every later run would skip them
+    if cache is not None:
+        if cache_rows and metadata_saved and manifest_saved:
+            with cache:
+                cache.executemany("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)", cache_rows)
+        cache.close()
+
+
+def filter_duplicates(
+    image_files: List[str],
+    threshold: int = 5,
+    skip_invalid: bool = True,
+    ctimes: Optional[Dict[str, float]] = None,
+) -> List[str]:
     """
     Filter out duplicate images using perceptual hashing.
+
+    ctimes optionally maps paths to creation times already known from the
+    directory scan; otherwise they are read with os.path.getctime.
     """
     print(f"Finding duplicate images with threshold {threshold}...")
     
     if not image_files:
         return []
     
-    # Compute hashes for all images
+    # Only --dedupe runs need the hashing code and its optional backends
+    from photo_hashing import hash_images, similar_hash_pairs
+
+    # Decode and hash every image in one parallel batch (shared with
+    # dedupe_photos), rather than one imagehash.phash task per file
     print("Computing image hashes...")
+    hashes = hash_images(image_files)
     hash_dict = {}
-    
-    # Create a mapping of files to results for easier failure detection
-    file_to_result = {}
-    for i, file_path in enumerate(image_files):
-        file_to_result[file_path] = None
-    
-    # Use multiprocessing for hash computation
-    num_workers = max(1, cpu_count() - 1)  # Leave one CPU free
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        # Use a dict to track which future corresponds to which file
-        future_to_file = {executor.submit(compute_image_hash, file_path): file_path 
-                         for file_path in image_files}
-        
-        # Process results as they complete
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_file), 
-            total=len(image_files),
-            desc="Hashing images",
-            unit="img"
-        ):
-            file_path = future_to_file[future]
-            try:
-                result = future.result()
-                file_to_result[file_path] = result
-                
-                if result is not None:
-                    img_path, h_str = result
-                    if h_str not in hash_dict:
-                        hash_dict[h_str] = []
-                    hash_dict[h_str].append(img_path)
-            except Exception as e:
-                print(f"Exception while processing {file_path}: {e}")
+    for img_path, h in hashes.items():
+        hash_dict.setdefault(f"{h:016x}", []).append(img_path)
     
     # Identify files that failed to hash
-    failed_files = [f for f in image_files if file_to_result[f] is None]
+    failed_files = [f for f in image_files if f not in hashes]
     
     if not hash_dict:
         print("No valid image hashes found. Returning all files as unique.")
         return image_files
     
-    # Find all groups of similar images
-    similar_images = []
-    processed_hashes = set()
-    
-    for h1_str, img_list1 in tqdm(hash_dict.items(), desc="Finding duplicates", unit="hash"):
-        if h1_str in processed_hashes:
-            continue
-            
-        current_group = set(img_list1)
-        processed_hashes.add(h1_str)
-        
-        try:
-            h1 = imagehash.hex_to_hash(h1_str)
-            
-            # Find all similar hashes
-            for h2_str, img_list2 in hash_dict.items():
-                if h2_str in processed_hashes or h2_str == h1_str:
-                    continue
-                    
-                try:
-                    h2 = imagehash.hex_to_hash(h2_str)
-                    if h1 - h2 <= threshold:
-                        current_group.update(img_list2)
-                        processed_hashes.add(h2_str)
-                except Exception as e:
-                    print(f"Error comparing hashes {h1_str} and {h2_str}: {e}")
-                    continue
-            
-            if current_group:
-                similar_images.append(list(current_group))
-        except Exception as e:
-            print(f"Error processing hash {h1_str}: {e}")
-            continue
+    # Find every pair of distinct hashes within threshold in one vectorized
+    # search (photo_hashing), then merge the pairs into groups
+    hash_strs = list(hash_dict)
+    parent = list(range(len(hash_strs)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    pairs = similar_hash_pairs([int(h, 16) for h in hash_strs], threshold)
+    for i, j in tqdm(pairs, desc="Finding duplicates", unit="pair"):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_i] = root_j
+
+    groups = {}
+    for i, h_str in enumerate(hash_strs):
+        groups.setdefault(find(i), []).extend(hash_dict[h_str])
     
     # Create a set for tracking unique images to keep
     unique_images = set()
     
-    # For each group, keep the oldest image
-    for group in similar_images:
-        if group:
-            try:
-                # Sort by creation time (oldest first)
-                group.sort(key=lambda x: os.path.getctime(x))
-                # Add the first (oldest) image to the unique set
-                unique_images.add(group[0])
-            except Exception as e:
-                print(f"Error sorting group by creation time: {e}")
-                # If sorting fails, just add the first one
-                unique_images.add(group[0])
-    
-    # Also add images that have no duplicates (singleton groups)
-    for h_str, img_list in hash_dict.items():
-        if len(img_list) == 1 and not any(img_list[0] in group for group in similar_images if len(group) > 1):
-            unique_images.add(img_list[0])
+    # For each group (including single images), keep the oldest image
+    for group in groups.values():
+        try:
+            # Sort by creation time (oldest first)
+            group.sort(key=ctimes.__getitem__ if ctimes is not None else os.path.getctime)
+        except Exception as e:
+            print(f"Error sorting group by creation time: {e}")
+        # Add the first (oldest) image to the unique set
+        unique_images.add(group[0])
     
     # Add files that failed hashing based on skip_invalid flag
     if not skip_invalid:
@@ -832,63 +1322,27 @@ def filter_duplicates(image_files: List[str], threshold: int = 5, skip_invalid:
     return list(unique_images)
 
 
-def compute_image_hash(img_path):
-    """Compute perceptual hash for a single image."""
-    try:
-        # Register HEIF/HEIC opener in the worker process
-        pillow_heif.register_heif_opener()
-        
-        # For HEIC files, convert to JPEG first
-        if img_path.lower().endswith(('.heic', '.heif')):
-            try:
-                with Image.open(img_path) as img:
-                    h = imagehash.phash(img)
-                    return str(img_path), str(h)
-            except Exception as e:
-                print(f"Error processing HEIC {img_path}: {e}")
-                return None
-        else:
-            # For regular images
-            img = Image.open(img_path)
-            h = imagehash.phash(img)
-            return str(img_path), str(h)
-    except Exception as e:
-        print(f"Error processing {img_path}: {e}")
-        return None
-
-
-def create_main_image(file_path: str) -> Tuple[Dict[str, io.BytesIO], Dict[str, Tuple[int, int]]]:
-    """Create optimized versions of an image in multiple sizes and return their dimensions"""
-    if file_path.lower().endswith((".heic", ".heif")) and CONVERT_HEIC:
-        # Convert HEIC to intermediate format first
-        jpeg_buffer = convert_heic_to_jpeg(file_path, WEB_IMAGE_QUALITY)
-        if jpeg_buffer:
-            try:
-                base_image = Image.open(jpeg_buffer)
-                # Apply orientation correction
-                base_image = apply_exif_orientation(base_image)
-            except Exception as e:
-                print(f"Error creating main image from HEIC {file_path}: {e}")
-                return {}, {}
-        else:
-            return {}, {}
-    else:
-        try:
-            base_image = Image.open(file_path)
-            # Apply orientation correction
-            base_image = apply_exif_orientation(base_image)
-        except Exception as e:
-            print(f"Error opening image {file_path}: {e}")
-            return {}, {}
+def create_image_outputs(
+    base_image: Image.Image, file_path: str
+) -> Tuple[Dict[str, io.BytesIO], Dict[str, Tuple[int, int]], Optional[io.BytesIO]]:
+    """Create optimized versions of an upright image in multiple sizes, their
+    dimensions, and its thumbnail
 
+    Sizes are made largest first, each resized from the one before it, and the
+    thumbnail from the smallest, so the full-resolution pixels are only read
+    by the first resize. Sizes the image already fits in are encoded once and
+    shared, and base_image is shrunk in place for the thumbnail.
+    """
     buffers = {}
     dimensions = {}
+    source = base_image
     try:
         # Get original dimensions
         orig_width, orig_height = base_image.size
         
-        for size_name, max_size in IMAGE_SIZES.items():
-            max_w, max_h = max_size
+        largest_first = sorted(IMAGE_SIZES, key=lambda name: IMAGE_SIZES[name][0] * IMAGE_SIZES[name][1], reverse=True)
+        for size_name in largest_first:
+            max_w, max_h = IMAGE_SIZES[size_name]
             
             # Calculate scaling factor to fit within max_w and max_h
             # while preserving aspect ratio
@@ -901,25 +1355,41 @@ def create_main_image(file_path: str) -> Tuple[Dict[str, io.BytesIO], Dict[str,
                 new_width = int(orig_width * ratio)
                 new_height = int(orig_height * ratio)
             
-            # Create copy and resize
-            image = base_image.copy()
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            # An image already within this size comes out the same as the
+            # previous one, so reuse its encoded bytes
+            if (new_width, new_height) == source.size and buffers:
+                buffers[size_name] = io.BytesIO(previous.getvalue())
+                dimensions[size_name] = (new_width, new_height)
+                continue
+            
+            # Resize from the previous (next larger) size. The reducing gap
+            # first shrinks by an integer factor with a cheap box reduce, so
+            # LANCZOS only runs on the last <2x of the downscale
+            image = source
+            if (new_width, new_height) != source.size:
+                image = source.resize(
+                    (new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=2.0
+                )
             
             # Save as WebP
             buffer = io.BytesIO()
             if image.mode == "RGBA":
-                image.save(buffer, format=MAIN_IMAGE_FORMAT, lossless=True)
+                image.save(buffer, format=MAIN_IMAGE_FORMAT, quality=MAIN_IMAGE_ALPHA_QUALITY, method=MAIN_IMAGE_METHOD)
             else:
-                image.save(buffer, format=MAIN_IMAGE_FORMAT, quality=MAIN_IMAGE_QUALITY, method=6)
+                image.save(buffer, format=MAIN_IMAGE_FORMAT, quality=MAIN_IMAGE_QUALITY, method=MAIN_IMAGE_METHOD)
             
             buffer.seek(0)
             buffers[size_name] = buffer
             dimensions[size_name] = (new_width, new_height)
+            source = image
+            previous = buffer
             
-        return buffers, dimensions
+        buffers = {name: buffers[name] for name in IMAGE_SIZES}
+        dimensions = {name: dimensions[name] for name in IMAGE_SIZES}
+        return buffers, dimensions, create_image_thumbnail(source)
     except Exception as e:
         print(f"Error processing main image for {file_path}: {e}")
-        return {}, {}
+        return {}, {}, None
 
 
 if __name__ == "__main__":
@@ -954,7 +1424,7 @@ if __name__ == "__main__":
         "--threads",
         type=int,
         default=MAX_WORKERS_THREAD,
-        help="Number of upload threads per process",
+        help="Number of upload threads",
     )
     parser.add_argument(
         "--dedupe",
@@ -972,6 +1442,17 @@ if __name__ == "__main__":
         action="store_true",
         help="Include invalid/problematic files (not recommended)",
     )
+    parser.add_argument(
+        "--upload-cache",
+        type=str,
+        default=UPLOAD_CACHE_PATH,
+        help=f"SQLite file recording uploaded files, which later runs skip (default: {UPLOAD_CACHE_PATH})",
+    )
+    parser.add_argument(
+        "--no-upload-cache",
+        action="store_true",
+        help="Process and upload every file, even if uploaded before",
+    )
     args = parser.parse_args()
 
     # Set global options from command line
@@ -985,4 +1466,5 @@ if __name__ == "__main__":
         ensure_bucket_exists(minio_client)
         generate_manifest(minio_client)
     else:
-        upload_photos(args.dir, dry_run=args.dry_run, dedupe=args.dedupe, threshold=args.threshold, skip_invalid=not args.include_invalid)
+        upload_photos(args.dir, dry_run=args.dry_run, dedupe=args.dedupe, threshold=args.threshold, skip_invalid=not args.include_invalid,
+                      cache_path=None if args.no_upload_cache else args.upload_cache)
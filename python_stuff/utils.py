@@ -2,15 +2,41 @@ import os
 from datetime import datetime
 
 from PIL import Image
-from PIL.ExifTags import TAGS
 import io
+import hashlib
 import subprocess
 import tempfile
-import mimetypes
 import json
 import re
-from typing import Tuple, Optional, List, Any, Dict
+from typing import Tuple, Optional, List, Any, Dict, BinaryIO
 import blurhash
+import pillow_heif
+
+# Register HEIF/HEIC file extensions with Pillow
+pillow_heif.register_heif_opener()
+
+HEIC_EXTENSIONS = frozenset((".heic", ".heif"))
+
+# EXIF tag IDs
+EXIF_ORIENTATION = 0x0112
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+
+def file_extension(file_path: str) -> str:
+    """Lowercased extension of a path, including the dot"""
+    return os.path.splitext(file_path)[1].lower()
+
+
+def content_digest(file_path: str) -> Optional[bytes]:
+    """BLAKE2b digest of a file's bytes, used to spot byte-identical copies"""
+    try:
+        with open(file_path, "rb") as f:
+            return hashlib.file_digest(f, "blake2b").digest()
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return None
 
 
 def generate_blurhash(image_path_or_buffer: Any, x_components: int = 4, y_components: int = 3) -> Optional[str]:
@@ -48,71 +74,67 @@ def generate_blurhash(image_path_or_buffer: Any, x_components: int = 4, y_compon
 
 
 def get_exif_date(
-    file_path: str, video_extensions: List[str], image_extensions: List[str]
+    file_path: str,
+    video_extensions: List[str],
+    image_extensions: List[str],
+    exiftool_date: Optional[datetime] = None,
+    image: Optional[Image.Image] = None,
 ) -> datetime:
     """Extract date from media metadata or use file modification date as fallback
     
-    Returns the full datetime object instead of just year/month tuple
+    Returns the full datetime object instead of just year/month tuple.
+    If exiftool_date is given (e.g. from ExifToolDaemon.get_dates), it is used
+    wherever exiftool would otherwise be run for this file. If image is given
+    (the already opened, not yet rotated file), its EXIF is read instead of
+    opening the file again.
     """
-    file_lower = file_path.lower()
+    ext = file_extension(file_path)
 
     # For videos, use ffprobe to extract creation date
-    if any(file_lower.endswith(ext) for ext in video_extensions):
+    if ext in video_extensions:
         try:
-            # Try using ffprobe to get creation date
+            # Try using ffprobe to get creation date, printed as a bare value
             cmd = [
                 "ffprobe",
                 "-v",
-                "quiet",
-                "-print_format",
-                "json",
+                "error",
                 "-show_entries",
-                "format_tags=creation_time:format=filename,duration",
+                "format_tags=creation_time",
+                "-of",
+                "default=nokey=1:noprint_wrappers=1",
                 file_path,
             ]
             result = subprocess.run(cmd, capture_output=True, text=True, check=False)
 
-            if result.returncode == 0:
-                metadata = json.loads(result.stdout)
-                # Try to find creation_time in tags
-                if (
-                    "format" in metadata
-                    and "tags" in metadata["format"]
-                    and "creation_time" in metadata["format"]["tags"]
-                ):
-                    creation_time = metadata["format"]["tags"]["creation_time"]
-                    # Parse ISO format date like "2023-04-15T12:30:45.000000Z"
-                    date_obj = datetime.fromisoformat(
-                        creation_time.replace("Z", "+00:00")
-                    )
-                    return date_obj
+            creation_time = result.stdout.strip()
+            if result.returncode == 0 and creation_time:
+                # Parse ISO format date like "2023-04-15T12:30:45.000000Z"
+                return datetime.fromisoformat(creation_time.replace("Z", "+00:00"))
 
             # Fallback to exiftool for video metadata
-            return extract_date_with_exiftool(file_path)
+            return exiftool_date or extract_date_with_exiftool(file_path)
         except Exception as e:
             print(f"Error extracting video metadata from {file_path}: {e}")
 
     # For HEIC/HEIF files, use exiftool
-    elif file_lower.endswith((".heic", ".heif")):
+    elif ext in HEIC_EXTENSIONS:
         try:
-            return extract_date_with_exiftool(file_path)
+            return exiftool_date or extract_date_with_exiftool(file_path)
         except Exception as e:
             print(f"Error extracting HEIC metadata from {file_path}: {e}")
 
     # For regular images, try EXIF data with PIL
     else:
         try:
-            image = Image.open(file_path)
-            exif_data = image._getexif()
-
-            if exif_data:
-                # Try to get the date the picture was taken
-                for tag_id, value in exif_data.items():
-                    tag = TAGS.get(tag_id, tag_id)
-                    if tag == "DateTimeOriginal":
-                        # Parse EXIF date format: "YYYY:MM:DD HH:MM:SS"
-                        date_obj = datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
-                        return date_obj
+            if image is None:
+                image = Image.open(file_path)
+            exif = image.getexif()
+
+            # Date the picture was taken (Exif IFD), else the IFD0 DateTime
+            value = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+            if value:
+                # Parse EXIF date format: "YYYY:MM:DD HH:MM:SS"
+                return datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
         except Exception as e:
             print(f"Error reading EXIF from {file_path}: {e}")
 
@@ -122,21 +144,46 @@ def get_exif_date(
     return date_obj
 
 
+# Common date tags to try in order of preference
+EXIFTOOL_DATE_TAGS = [
+    "DateTimeOriginal",
+    "CreateDate",
+    "MediaCreateDate",
+    "TrackCreateDate",
+    "CreationDate",
+]
+# Date part of an exiftool date string without a parseable time, e.g. "YYYY:MM:DD"
+EXIFTOOL_DATE_RE = re.compile(r"(\d{4}):(\d{2}):(\d{2})")
+
+
+def parse_exiftool_date(metadata: Dict[str, Any]) -> Optional[datetime]:
+    """Pick the preferred date out of one file's exiftool JSON record"""
+    # Try each date tag in order of preference
+    for tag in EXIFTOOL_DATE_TAGS:
+        if tag in metadata:
+            date_str = metadata[tag]
+            # Handle various date formats
+            if ":" in date_str:
+                # Try common formats
+                try:
+                    # Format: "YYYY:MM:DD HH:MM:SS"
+                    return datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
+                except ValueError:
+                    # Try alternate format: "YYYY:MM:DD"
+                    match = EXIFTOOL_DATE_RE.search(date_str)
+                    if match:
+                        year, month, day = int(match.group(1)), int(match.group(2)), int(match.group(3))
+                        # Set time to midnight if no time info
+                        return datetime(year, month, day, 0, 0, 0)
+    return None
+
+
 def extract_date_with_exiftool(file_path: str) -> datetime:
     """Extract creation date using exiftool as a fallback method"""
     try:
-        # Common date tags to try in order of preference
-        date_tags = [
-            "DateTimeOriginal",
-            "CreateDate",
-            "MediaCreateDate",
-            "TrackCreateDate",
-            "CreationDate",
-        ]
-
         # Build exiftool command to extract these tags
         tag_args = []
-        for tag in date_tags:
+        for tag in EXIFTOOL_DATE_TAGS:
             tag_args.extend(["-" + tag])
 
         cmd = ["exiftool", "-j", *tag_args, file_path]
@@ -145,23 +192,9 @@ def extract_date_with_exiftool(file_path: str) -> datetime:
         if result.returncode == 0:
             metadata = json.loads(result.stdout)
             if metadata and isinstance(metadata, list) and len(metadata) > 0:
-                # Try each date tag in order of preference
-                for tag in date_tags:
-                    if tag in metadata[0]:
-                        date_str = metadata[0][tag]
-                        # Handle various date formats
-                        if ":" in date_str:
-                            # Try common formats
-                            try:
-                                # Format: "YYYY:MM:DD HH:MM:SS"
-                                return datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
-                            except ValueError:
-                                # Try alternate format: "YYYY:MM:DD"
-                                match = re.search(r"(\d{4}):(\d{2}):(\d{2})", date_str)
-                                if match:
-                                    year, month, day = int(match.group(1)), int(match.group(2)), int(match.group(3))
-                                    # Set time to midnight if no time info
-                                    return datetime(year, month, day, 0, 0, 0)
+                date_obj = parse_exiftool_date(metadata[0])
+                if date_obj:
+                    return date_obj
     except Exception as e:
         print(f"Error extracting date with exiftool: {e}")
 
@@ -171,90 +204,152 @@ def extract_date_with_exiftool(file_path: str) -> datetime:
     return date_obj
 
 
-def convert_heic_to_jpeg(
-    heic_path: str, web_image_quality: int
-) -> Optional[io.BytesIO]:
-    """Convert HEIC to JPEG format using sips (macOS) or PIL with pillow-heif"""
-    try:
-        # Using macOS sips command (more reliable than Python libraries)
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=True) as temp_jpg:
-            subprocess.run(
-                [
-                    "sips",
-                    "-s",
-                    "format",
-                    "jpeg",
-                    "-s",
-                    "formatOptions",
-                    str(web_image_quality),
-                    heic_path,
-                    "--out",
-                    temp_jpg.name,
-                ],
-                check=True,
-                capture_output=True,
-            )
+class ExifToolDaemon:
+    """
+    A single long-lived `exiftool -stay_open` process for reading dates in bulk.
 
-            # Read the converted file into a buffer
-            with open(temp_jpg.name, "rb") as f:
-                jpeg_data = f.read()
-                buffer = io.BytesIO(jpeg_data)
-                buffer.seek(0)
-                return buffer
-    except subprocess.CalledProcessError as e:
-        print(f"Error converting HEIC using sips: {e}")
-        # Could add fallback to pillow-heif here if needed
-        return None
+    Starting exiftool costs a few hundred milliseconds, far more than reading
+    one file's tags, so batching many files through one process avoids paying
+    that startup per file.
+
+    Usage:
+        with ExifToolDaemon() as exiftool:
+            dates = exiftool.get_dates(paths)
+    """
+
+    BATCH_SIZE = 500  # Files per -execute, keeps each JSON response a manageable size
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Ask exiftool to exit and wait for it"""
+        if self.process.poll() is None:
+            self.process.stdin.write("-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=10)
+
+    def execute(self, args: List[str]) -> str:
+        """Run one exiftool command and return its stdout"""
+        self.process.stdin.write("\n".join(args) + "\n-execute\n")
+        self.process.stdin.flush()
+        output = []
+        for line in self.process.stdout:
+            if line.rstrip() == "{ready}":
+                break
+            output.append(line)
+        return "".join(output)
+
+    def get_dates(self, paths: List[str]) -> Dict[str, datetime]:
+        """
+        Read creation dates for many files.
+
+        Uses the same tag preference and modification-time fallback as
+        extract_date_with_exiftool, so every path gets a date.
+        """
+        tag_args = ["-" + tag for tag in EXIFTOOL_DATE_TAGS]
+        dates = {}
+        for start in range(0, len(paths), self.BATCH_SIZE):
+            batch = paths[start:start + self.BATCH_SIZE]
+            try:
+                output = self.execute(["-j", *tag_args, *batch])
+                for metadata in json.loads(output) if output.strip() else []:
+                    date_obj = parse_exiftool_date(metadata)
+                    if date_obj:
+                        dates[metadata["SourceFile"]] = date_obj
+            except Exception as e:
+                print(f"Error extracting dates with exiftool: {e}")
+
+        # If exiftool has no date, use file modification time
+        for path in paths:
+            if path not in dates:
+                dates[path] = datetime.fromtimestamp(os.path.getmtime(path))
+        return dates
+
+
+def open_heic_image(heic_path: str, fp: Optional[BinaryIO] = None) -> Optional[Image.Image]:
+    """
+    Decode a HEIC/HEIF file in-process with pillow-heif.
+
+    pillow-heif applies the file's rotation/mirroring while decoding and resets
+    the EXIF orientation to 1, so the returned RGB image is already upright.
+
+    Args:
+        heic_path: Path to the HEIC/HEIF file
+        fp: The file's contents, if already read, to decode instead of reading heic_path
+
+    Returns:
+        Optional[Image.Image]: Decoded RGB image, or None if decoding fails
+    """
+    try:
+        image = Image.open(fp if fp is not None else heic_path)
+        image.load()
+        # convert() to the same mode would copy the full-size image
+        return image if image.mode == "RGB" else image.convert("RGB")
     except Exception as e:
-        print(f"Error in HEIC conversion: {e}")
+        print(f"Error decoding HEIC {heic_path}: {e}")
         return None
 
 
 def create_video_thumbnail(video_path: str, size: Tuple[int, int] = (300, -1)) -> Optional[io.BytesIO]:
     """Extract a thumbnail from a video file using ffmpeg"""
     try:
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=True) as temp_jpg:
-            # Set a timeout for ffmpeg process
-            width, height = size
-            scale_param = f"scale={width}:{height if height != -1 else '-1'}"
-            
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-i",
-                video_path,
-                "-ss",
-                "00:00:00.000",  # Extract from the start of the video instead of 1 second in
-                "-vframes",
-                "1",
-                "-vf",
-                scale_param,
-                temp_jpg.name,
-            ]
-            
-            process = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=False,
-                timeout=15,  # Increased timeout to 15 seconds
-            )
+        # Set a timeout for ffmpeg process
+        width, height = size
+        scale_param = f"scale={width}:{height if height != -1 else '-1'}"
 
-            if process.returncode != 0:
-                print(f"FFmpeg error for {os.path.basename(video_path)}: {process.stderr[:200]}...")
-                return None
+        # Write the JPEG to stdout rather than a temp file. Only keyframes are
+        # decoded, so the first frame (always a keyframe) comes out without
+        # decoding the rest of its GOP, and audio is never touched
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-skip_frame",
+            "nokey",
+            "-i",
+            video_path,
+            "-an",
+            "-vframes",
+            "1",
+            "-vf",
+            scale_param,
+            "-f",
+            "image2pipe",
+            "-vcodec",
+            "mjpeg",
+            "pipe:1",
+        ]
 
-            # Check if thumbnail was created
-            if not os.path.exists(temp_jpg.name) or os.path.getsize(temp_jpg.name) == 0:
-                print(f"FFmpeg didn't create a valid thumbnail for {os.path.basename(video_path)}")
-                return None
+        process = subprocess.run(
+            cmd,
+            capture_output=True,
+            check=False,
+            timeout=15,  # Increased timeout to 15 seconds
+        )
+
+        if process.returncode != 0:
+            stderr = process.stderr.decode(errors="replace")
+            print(f"FFmpeg error for {os.path.basename(video_path)}: {stderr[:200]}...")
+            return None
+
+        # Check if thumbnail was created
+        if not process.stdout:
+            print(f"FFmpeg didn't create a valid thumbnail for {os.path.basename(video_path)}")
+            return None
 
-            # Read the thumbnail into a buffer
-            with open(temp_jpg.name, "rb") as f:
-                jpeg_data = f.read()
-                buffer = io.BytesIO(jpeg_data)
-                buffer.seek(0)
-                return buffer
+        return io.BytesIO(process.stdout)
 
     except subprocess.TimeoutExpired:
         print(f"Timeout while creating thumbnail for {os.path.basename(video_path)} - ffmpeg process took too long")
@@ -267,37 +362,16 @@ def create_video_thumbnail(video_path: str, size: Tuple[int, int] = (300, -1)) -
         return None
 
 
-def get_content_type(
-    file_path: str, video_extensions: List[str], image_extensions: List[str]
-) -> str:
-    """Get the MIME type for a file"""
-    # Add additional mime types not correctly identified by mimetypes
-    if file_path.lower().endswith(".heic"):
-        return "image/heic"
-
-    mime_type, _ = mimetypes.guess_type(file_path)
-    if mime_type:
-        return mime_type
-
-    # Fallback based on extension
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext in image_extensions:
-        return f"image/{ext[1:]}"
-    elif ext in video_extensions:
-        return f"video/{ext[1:]}"
-
-    return "application/octet-stream"
-
-
-def validate_video_file(video_path: str) -> Tuple[bool, str]:
+def probe_video(video_path: str) -> Tuple[bool, str, Optional[float], Optional[float]]:
     """
-    Validate a video file to check if it's playable and not corrupted.
+    Validate a video file and read its duration and size with a single ffprobe run.
     
     Args:
         video_path: Path to the video file
         
     Returns:
-        Tuple of (is_valid, error_message)
+        Tuple of (is_valid, message, duration_seconds, size_mb); duration and
+        size are None when the file is invalid or ffprobe doesn't report them
     """
     try:
         # Use ffprobe to check if the file is valid
@@ -319,13 +393,13 @@ def validate_video_file(video_path: str) -> Tuple[bool, str]:
         )
         
         if process.returncode != 0:
-            return False, f"FFprobe validation failed: {process.stderr.strip()}"
+            return False, f"FFprobe validation failed: {process.stderr.strip()}", None, None
         
         # Parse the output
         try:
             data = json.loads(process.stdout)
             if not data.get("streams"):
-                return False, "No video streams found in file"
+                return False, "No video streams found in file", None, None
                 
             # Get video information
             stream = data["streams"][0]
@@ -335,7 +409,7 @@ def validate_video_file(video_path: str) -> Tuple[bool, str]:
             
             # Get duration from format section (more reliable)
             duration = None
-            file_size_bytes = None
+            size_mb = None
             if "format" in data:
                 duration_str = data["format"].get("duration")
                 if duration_str:
@@ -343,82 +417,26 @@ def validate_video_file(video_path: str) -> Tuple[bool, str]:
                 
                 size_str = data["format"].get("size")
                 if size_str:
-                    file_size_bytes = int(size_str)
+                    size_mb = int(size_str) / (1024 * 1024)
             
             result_msg = f"Valid video: {codec} {width}x{height}"
             if duration is not None:
                 result_msg += f", duration: {duration:.2f}s"
-            if file_size_bytes is not None:
-                size_mb = file_size_bytes / (1024 * 1024)
+            if size_mb is not None:
                 result_msg += f", size: {size_mb:.2f}MB"
                 
-            return True, result_msg
+            return True, result_msg, duration, size_mb
             
         except json.JSONDecodeError:
-            return False, "Failed to parse ffprobe output"
+            return False, "Failed to parse ffprobe output", None, None
             
     except subprocess.TimeoutExpired:
-        return False, "Timeout while validating video"
+        return False, "Timeout while validating video", None, None
     except Exception as e:
-        return False, f"Error validating video: {e.__class__.__name__}: {e}"
+        return False, f"Error validating video: {e.__class__.__name__}: {e}", None, None
 
 
-def get_video_metadata(video_path: str) -> Tuple[Optional[float], Optional[float]]:
-    """
-    Get video duration and size in MB.
-    
-    Args:
-        video_path: Path to the video file
-        
-    Returns:
-        Tuple of (duration_seconds, size_mb) or (None, None) if not available
-    """
-    try:
-        # Use ffprobe to get metadata
-        cmd = [
-            "ffprobe", 
-            "-v", "error",
-            "-show_entries", "format=duration,size", 
-            "-of", "json",
-            video_path
-        ]
-        
-        process = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=False,
-            timeout=10
-        )
-        
-        if process.returncode != 0:
-            return None, None
-        
-        # Parse the output
-        data = json.loads(process.stdout)
-        
-        duration = None
-        size_mb = None
-        
-        if "format" in data:
-            # Get duration
-            duration_str = data["format"].get("duration")
-            if duration_str:
-                duration = float(duration_str)
-            
-            # Get file size
-            size_str = data["format"].get("size")
-            if size_str:
-                size_mb = int(size_str) / (1024 * 1024)
-        
-        return duration, size_mb
-        
-    except Exception as e:
-        print(f"Error getting video metadata: {e}")
-        return None, None
-
-
-def optimize_video(video_path: str) -> Optional[io.BytesIO]:
+def optimize_video(video_path: str) -> Optional[bytes]:
     """
     Optimize video using FFmpeg with the following settings:
     - Resolution: 854x480 (preserving aspect ratio)
@@ -436,7 +454,7 @@ def optimize_video(video_path: str) -> Optional[io.BytesIO]:
         video_path: Path to the input video file
         
     Returns:
-        Optional[io.BytesIO]: Buffer containing the optimized video, or None if optimization fails
+        Optional[bytes]: The optimized video, or None if optimization fails
     """
     try:
         with tempfile.NamedTemporaryFile(suffix=".mp4", delete=True) as temp_mp4:
@@ -505,12 +523,10 @@ def optimize_video(video_path: str) -> Optional[io.BytesIO]:
                 print(f"FFmpeg didn't create a valid output for {os.path.basename(video_path)}")
                 return None
             
-            # Read the optimized video into a buffer
+            # Read the optimized video before the temp file is removed; it is
+            # handed back to the main process for upload as bytes anyway
             with open(temp_mp4.name, "rb") as f:
-                video_data = f.read()
-                buffer = io.BytesIO(video_data)
-                buffer.seek(0)
-                return buffer
+                return f.read()
                 
     except subprocess.TimeoutExpired:
         print(f"Timeout while optimizing video {os.path.basename(video_path)} - ffmpeg process took too long")
@@ -518,26 +534,3 @@ def optimize_video(video_path: str) -> Optional[io.BytesIO]:
     except Exception as e:
         print(f"Error optimizing video {os.path.basename(video_path)}: {e.__class__.__name__}: {e}")
         return None
-
-
-def validate_image_file(file_path: str) -> Tuple[bool, str]:
-    """
-    Validate an image file to check if it can be processed correctly.
-    
-    Args:
-        file_path: Path to the image file
-        
-    Returns:
-        Tuple of (is_valid, error_message)
-    """
-    try:
-        img = Image.open(file_path)
-        width, height = img.size
-        
-        # Check for invalid dimensions
-        if width <= 0 or height <= 0:
-            return False, f"Invalid image dimensions: {width}x{height}"
-            
-        return True, f"Valid image: {width}x{height}"
-    except Exception as e:
-        return False, f"Error validating image: {e.__class__.__name__}: {e}"